@@ -6,8 +6,25 @@ Information returned is the internet volume.
 Based on https://github.com/KillianMeersman/telemeter
 """
 
+import base64
+import contextlib
+import datetime
+import errno
+import hashlib
 import json
+import os
+import re
 import requests
+import socket
+import tempfile
+import threading
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+try:
+    import fcntl
+except ImportError:
+    fcntl = None                    # no advisory locks (Windows): entries are still written atomically
 
 TELENET = 'https://api.prd.telenet.be'
 TELENET_URI_OAUTH = '/ocapi/oauth/userdetails'
@@ -19,21 +36,290 @@ TELENET_URI_CUSTOMERS = '/ocapi/public/api/customer-service/v1/customers'
 TELENET_URI_CONTRACT_ADDRESSES = '/ocapi/public/api/contact-service/v1/contact/addresses/{}'
 TELENET_URI_BILLING_CYCLE = '/ocapi/public/api/billing-service/v1/account/products/{}/billcycle-details?producttype=internet&count=3'
 TELENET_URI_ADDRESS = '/ocapi/public/api/contact-service/v1/contact/addresses/{}'
+TELENET_SESSION_VERSION = 1
+TELENET_METADATA_TTL = 24*3600     # contracts, subscriptions and addresses hardly change
+TELENET_MAX_WORKERS = 4            # parallel usage requests (and size of the connection pool)
+TELENET_TIMEOUT = (5, 15)          # connect and read timeout (seconds) of a single request
+TELENET_CYCLE_BUDGET = 60          # total time (seconds) allowed for one polling cycle
+TELENET_LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+TELENET_CACHE_TTL = { 'SUBSCRIPTIONS': 3600,      # seconds a GET response is served from the shared cache, per endpoint
+                      'ADDRESS': 24*3600,
+                      'BILLING_CYCLE': 3600,
+                      'INTERNET_USAGE': 900 }
+TELENET_CACHE_LOCK_STRIPES = 256   # lock files shared by the cache entries
+
+class TelenetMetrics():
+    # Per-endpoint request counters, latency histograms and response sizes
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.endpoints = {}
+        self.retries = 0
+        self.relogins = 0
+        self.cache_hits = 0
+        self.cycles = 0
+        self.cycle_requests = 0
+        self.cycle_start = None
+        self.last_cycle = {}
+        # Later URI definitions win when templates are identical (ADDRESS over CONTRACT_ADDRESSES)
+        self.patterns = [ (name[12:], re.compile(re.escape(uri.split('?')[0]).replace(re.escape('{}'), '[^/]+') + '$'))
+                          for name, uri in reversed(list(globals().items())) if name.startswith('TELENET_URI_') ]
+
+    def endpoint(self, uri):
+        path = uri.split('?')[0]
+        for name, pattern in self.patterns:
+            if pattern.match(path):
+                return name
+        return path
+
+    def record(self, uri, duration, status=None, size=0):
+        name = self.endpoint(uri)
+        with self.lock:
+            endpoint = self.endpoints.setdefault(name, { 'requests': 0, 'errors': 0, 'status': {}, 'bytes': 0, 'seconds': 0.0, 'max_seconds': 0.0,
+                                                         'histogram': [0] * (len(TELENET_LATENCY_BUCKETS)+1) })
+            endpoint['requests'] += 1
+            endpoint['seconds'] += duration
+            endpoint['max_seconds'] = max(endpoint['max_seconds'], duration)
+            endpoint['bytes'] += size
+            endpoint['histogram'][sum(1 for bucket in TELENET_LATENCY_BUCKETS if duration > bucket)] += 1
+            if status is None:
+                endpoint['errors'] += 1
+            else:
+                endpoint['status'][str(status)] = endpoint['status'].get(str(status), 0) + 1
+            self.cycle_requests += 1
+
+    def start_cycle(self):
+        with self.lock:
+            self._end_cycle()
+            self.cycles += 1
+            self.cycle_requests = 0
+            self.cycle_start = time.monotonic()
+
+    def _end_cycle(self):
+        if self.cycle_start is not None:
+            self.last_cycle = { 'requests': self.cycle_requests, 'seconds': time.monotonic() - self.cycle_start }
+
+    def snapshot(self):
+        with self.lock:
+            current = { 'requests': self.cycle_requests, 'seconds': time.monotonic() - self.cycle_start } if self.cycle_start is not None else {}
+            return { 'endpoints': json.loads(json.dumps(self.endpoints)),
+                     'latency_buckets': list(TELENET_LATENCY_BUCKETS),
+                     'retries': self.retries,
+                     'relogins': self.relogins,
+                     'cache_hits': self.cache_hits,
+                     'cycles': self.cycles,
+                     'current_cycle': current,
+                     'last_cycle': dict(self.last_cycle) }
+
+class TelenetCancelled(requests.exceptions.RequestException):
+    pass
+
+class _CancellableAdapter(requests.adapters.HTTPAdapter):
+    # HTTPAdapter that registers its sockets so that blocking reads can be aborted
+    def __init__(self, sockets, **kwargs):
+        self.sockets = sockets
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        pool_classes = {}
+        for scheme, pool_class in self.poolmanager.pool_classes_by_scheme.items():
+            pool_classes[scheme] = type(pool_class.__name__, (pool_class,), { 'ConnectionCls': _registering_connection(pool_class.ConnectionCls, self.sockets) })
+        self.poolmanager.pool_classes_by_scheme = pool_classes
+
+def _registering_connection(connection_class, sockets):
+    class Connection(connection_class):
+        abort_socket = None
+
+        def _new_conn(self):
+            # Registered before connect() wraps the socket for TLS, so that the handshake can be aborted too.
+            # The wrapped socket detaches the original one: a duplicate keeps a handle for shutdown().
+            sock = super()._new_conn()
+            self._close_abort_socket()
+            self.abort_socket = sock.dup()
+            sockets.add(self.abort_socket)
+            return sock
+
+        def close(self):
+            super().close()
+            self._close_abort_socket()
+
+        def _close_abort_socket(self):
+            if self.abort_socket is not None:
+                self.abort_socket.close()
+                self.abort_socket = None
+    return Connection
+
+def create_adapter(accounts=1):
+    # Connection pool that clients of several accounts can share (cookies stay per client)
+    return _CancellableAdapter(weakref.WeakSet(), pool_connections=1, pool_maxsize=TELENET_MAX_WORKERS*accounts)
+
+class TelenetResponseCache():
+    # GET responses on disk, shared by processes: one advisory lock per entry (striped) and atomic writes
+
+    def __init__(self, folder):
+        self.folder = folder
+        os.makedirs(folder, mode=0o700, exist_ok=True)
+        # Entries and lock files are created in the folder: fail here rather than on every request
+        if not os.access(folder, os.W_OK | os.X_OK):
+            raise PermissionError(errno.EACCES, 'Cache folder is not writable', folder)
+        self.prune()
+
+    def fetch(self, key, ttl, request, refresh=False, wait=0, cancelled=None):
+        # Serve a fresh entry without locking; otherwise one process refreshes it while the others wait
+        digest = hashlib.sha256('\0'.join(key).encode('utf-8')).hexdigest()
+        cancelled = cancelled or threading.Event()
+        path = os.path.join(self.folder, 'telenet-{}.json'.format(digest))
+        if not refresh:
+            r = self._read(path, ttl)
+            if r is not None:
+                return r
+        with self._locked(os.path.join(self.folder, 'telenet-{:02x}.lock'.format(int(digest, 16) % TELENET_CACHE_LOCK_STRIPES)), wait, cancelled):
+            if not refresh:
+                r = self._read(path, ttl)
+                if r is not None:
+                    return r
+            r = request()
+            if r.status_code == 200:
+                self._write(path, { 'time': time.time(), 'url': r.url, 'status': r.status_code, 'content': r.content.decode('utf-8') })
+            return r
+
+    def prune(self):
+        # Entries are never served after the largest TTL
+        limit = time.time() - max(TELENET_CACHE_TTL.values())
+        for name in os.listdir(self.folder):
+            path = os.path.join(self.folder, name)
+            try:
+                if name.startswith('telenet-') and name.endswith('.json') and os.path.getmtime(path) < limit:
+                    os.remove(path)
+            except OSError:
+                pass
+
+    def _read(self, path, ttl):
+        try:
+            with open(path, 'r', encoding='utf-8') as infile:
+                entry = json.load(infile)
+            if not 0 <= time.time() - entry['time'] < ttl:
+                return None
+            r = requests.Response()
+            r.status_code = entry['status']
+            r.url = entry['url']
+            r.encoding = 'utf-8'
+            r._content = entry['content'].encode('utf-8')
+            r.from_cache = True
+            return r
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+    def _write(self, path, entry):
+        # Readers see the old or the new entry, never a partial one
+        fd, temp = tempfile.mkstemp(dir=self.folder, prefix='.telenet-', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as outfile:
+                json.dump(entry, outfile)
+            os.replace(temp, path)
+        except OSError:
+            with contextlib.suppress(OSError):
+                os.remove(temp)
+
+    @contextlib.contextmanager
+    def _locked(self, path, wait, cancelled):
+        # A process holding the lock too long (or a cancelled client) does not block polling: fetch unlocked
+        if fcntl is None:
+            yield
+            return
+        with open(path, 'a') as lockfile:
+            deadline = time.monotonic() + wait
+            while True:
+                try:
+                    fcntl.flock(lockfile.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    locked = True
+                    break
+                except OSError:
+                    locked = False
+                    if time.monotonic() >= deadline or cancelled.wait(0.05):
+                        break
+            try:
+                yield
+            finally:
+                if locked:
+                    fcntl.flock(lockfile.fileno(), fcntl.LOCK_UN)
+
+class Contract():
+    # One internet subscription, kept across polls and updated in place by the client
+    __slots__ = ('businessidentifier', 'addressId', 'municipality', 'street', 'housenr',
+                 'total_usage_gb', 'daily_usage_gb', 'usage_ok', 'usage_changed', 'reported')
+
+    def __init__(self, businessidentifier, addressId=None):
+        self.businessidentifier = businessidentifier
+        self.addressId = addressId
+        self.municipality = None
+        self.street = None
+        self.housenr = None
+        self.total_usage_gb = 0
+        self.daily_usage_gb = []
+        self.usage_ok = False
+        self.usage_changed = False     # the last set_usage() received a different usage
+        self.reported = False          # the caller has handled the current usage, see mark_reported()
+
+    def __repr__(self):
+        return 'Contract({})'.format(', '.join('{}={!r}'.format(name, getattr(self, name)) for name in self.__slots__))
+
+    def set_address(self, address):
+        self.municipality, self.street, self.housenr = address['municipality'], address['street'], address['housenr']
+
+    def set_usage(self, total_usage_gb, daily_usage_gb):
+        self.usage_ok = True
+        self.usage_changed = total_usage_gb != self.total_usage_gb or daily_usage_gb != self.daily_usage_gb
+        if self.usage_changed:
+            self.total_usage_gb, self.daily_usage_gb = total_usage_gb, daily_usage_gb
+            self.reported = False
+
+    def mark_reported(self):
+        # Called once the usage returned by telemeter() has been handled: it is not returned again until it changes
+        self.reported = True
+
+    def invalidate(self):
+        # Report the usage again with the next successful poll (e.g. after its device was timed out)
+        self.reported = False
 
 class Telenet():
 
-    def __init__(self, username, password):
+    def __init__(self, username, password, metadata_ttl=TELENET_METADATA_TTL, base_url=None, adapter=None, cache_folder=None, cache=None):
         self.username = username
         self.password = password
-        self.telemeter_info = None
+        self.metadata_ttl = metadata_ttl
+        self.base_url = base_url or TELENET
+        self.metadata_time = None
+        self.contracts = None           # business identifier: Contract
+        self.billing_cycles = {}
+        self.timeout = TELENET_TIMEOUT
+        self.deadline = None
+        self.metrics = TelenetMetrics()
+        # A cache instance can be shared by the clients of several accounts (the folder is pruned once)
+        self.cache = cache or (TelenetResponseCache(cache_folder) if cache_folder else None)
+        self.authenticated = False
+        self.login_count = 0
+        self.login_lock = threading.RLock()
+        self.cancelled = threading.Event()
+        self.shared_adapter = adapter is not None
+        adapter = adapter or create_adapter()
+        self.sockets = adapter.sockets
         self.s = requests.Session()
+        self.s.mount('https://', adapter)
+        self.s.mount('http://', adapter)
         self.s.headers['User-Agent'] = 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/115.0.0.0 Safari/537.36'
 
     def login(self):
+        with self.login_lock:
+            self.authenticated = self._login()
+            return self.authenticated
+
+    def _login(self):
         # Get OAuth2 state / nonce
         headers = {'x-alt-referer': 'https://www2.telenet.be/nl/klantenservice/#/pages=1/menu=selfservice'}
         try:
-            r = self.s.get('{}{}'.format(TELENET, TELENET_URI_OAUTH), headers=headers)
+            r = self._request('GET', TELENET_URI_OAUTH, reauth=False, headers=headers)
         except:
             return False
         
@@ -45,10 +331,10 @@ class Telenet():
             state, nonce = r.text.split(',', maxsplit=2)
 
             # Log in
-            r = self.s.get('{}{}'.format(TELENET, TELENET_URI_LOGIN.format(state=state, nonce=nonce)))
             data = {'j_username': self.username, 'j_password': self.password, 'rememberme': True}
             try:
-                r = self.s.post('{}{}'.format(TELENET, TELENET_URI_DO_LOGIN), data=data)
+                r = self._request('GET', TELENET_URI_LOGIN.format(state=state, nonce=nonce), reauth=False)
+                r = self._request('POST', TELENET_URI_DO_LOGIN, reauth=False, data=data)
             except:
                 return False
             if r.status_code != 200:
@@ -56,60 +342,230 @@ class Telenet():
                 
             self.s.headers["X-TOKEN-XSRF"] = self.s.cookies.get("TOKEN-XSRF")
             try:
-                r = self.s.get('{}{}'.format(TELENET, TELENET_URI_OAUTH))
+                r = self._request('GET', TELENET_URI_OAUTH, reauth=False)
             except:
                 return False
 
             if r.status_code == 200:
+                self.login_count += 1
                 return True
         
         return False
         
-    def get_user_data(self):
-        self.telemeter_info = []
-        if self._get_product_subscriptions():
+    def get_user_data(self, force=False):
+        # Serve contract metadata from cache while it is fresh
+        if not force and self.metadata_time is not None and time.time() - self.metadata_time < self.metadata_ttl:
             return True
-        else:
-            return False
+        contracts = self._get_product_subscriptions(cached=not force)
+        if contracts is not None:
+            self.contracts = contracts
+            self.metadata_time = time.time()
+            return True
+        # Keep serving the last good metadata when the refresh fails
+        return self.contracts is not None
+
+    @property
+    def telemeter_info(self):
+        return list(self.contracts.values()) if self.contracts is not None else None
+
+    def invalidate_user_data(self):
+        self.metadata_time = None
 
     def telemeter(self):
-        current_period = self._get_last_period(self.telemeter_info[0]['businessidentifier'])
-        if current_period:
-            for i, telemeter in enumerate(self.telemeter_info):
-                try:
-                    r = self.s.get('{}{}'.format(TELENET, TELENET_URI_INTERNET_USAGE.format(self.telemeter_info[0]['businessidentifier'], current_period)))
-                except:
+        # Fetch the usage of all contracts in parallel (see usage_ok for the result per contract);
+        # returns the contracts with a usage that was not reported before (see Contract.mark_reported)
+        if not self.contracts:
+            return []
+        contracts = list(self.contracts.values())
+        with ThreadPoolExecutor(max_workers=min(len(contracts), TELENET_MAX_WORKERS), thread_name_prefix='TelenetUsage') as executor:
+            list(executor.map(self._get_usage, contracts))
+        for contract in contracts:
+            if not contract.usage_ok:
+                contract.invalidate()
+        return [ contract for contract in contracts if contract.usage_ok and not contract.reported ]
+
+    def invalidate_usage(self):
+        for contract in (self.contracts or {}).values():
+            contract.invalidate()
+
+    def _get_usage(self, contract):
+        contract.usage_ok, contract.usage_changed = False, False
+        current_period = self._get_last_period(contract.businessidentifier)
+        if not current_period:
+            return False
+        try:
+            r = self._request('GET', TELENET_URI_INTERNET_USAGE.format(contract.businessidentifier, current_period))
+            if r.status_code == 400:
+                # Period no longer valid: refresh the billing cycle once and retry
+                current_period = self._get_last_period(contract.businessidentifier, force=True)
+                if not current_period:
                     return False
-                if r.status_code == 200:
-                    data = r.json()
-                    if data['internet']['totalUsage']['unitType']:
-                        self.telemeter_info[i]['total_usage_gb'] = data['internet']['totalUsage']['units']
-            return True
-        return False
-        
+                r = self._request('GET', TELENET_URI_INTERNET_USAGE.format(contract.businessidentifier, current_period))
+        except:
+            return False
+        if r.status_code == 200:
+            try:
+                data = r.json()
+                if data['internet']['totalUsage']['unitType']:
+                    contract.set_usage(data['internet']['totalUsage']['units'], _parse_daily_usage(data))
+            except (ValueError, KeyError, TypeError):
+                # An unexpected response only fails this contract
+                return False
+        return contract.usage_ok
+
+    def get_past_daily_usage(self, contract, since=''):
+        # Daily usage of the previous billing cycles that end after 'since' (YYYY-MM-DD), one request per cycle
+        daily_usage = []
+        cycle = self.billing_cycles.get(contract.businessidentifier, {})
+        for billperiod in cycle.get('previous', []):
+            if billperiod['endDate'][:10] <= since:
+                continue
+            try:
+                r = self._request('GET', TELENET_URI_INTERNET_USAGE.format(contract.businessidentifier, 'fromDate={}&toDate={}'.format(billperiod['startDate'], billperiod['endDate'])))
+            except:
+                continue
+            if r.status_code == 200:
+                try:
+                    daily_usage += [ day for day in _parse_daily_usage(r.json()) if day[0] > since ]
+                except (ValueError, KeyError, TypeError):
+                    continue
+        return sorted(daily_usage)
+
+    def start_cycle(self, budget=TELENET_CYCLE_BUDGET):
+        # All requests until the next start_cycle() share this time budget
+        self.deadline = time.monotonic() + budget if budget else None
+        self.metrics.start_cycle()
+
+    def cancel(self):
+        # Abort in-flight requests (also from another thread) and refuse new ones
+        # A shared adapter aborts the requests of all clients using it
+        self.cancelled.set()
+        for sock in list(self.sockets):
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        self.close()
+
     def close(self):
-        self.s.close()
-        
-    def _get_product_subscriptions(self):
+        # A shared adapter is closed by its owner
+        if not self.shared_adapter:
+            self.s.close()
+
+    def _request(self, method, uri, reauth=True, cached=True, **kwargs):
+        # Data calls can be served by the shared cache; cached=False refreshes the entry
+        ttl = TELENET_CACHE_TTL.get(self.metrics.endpoint(uri)) if self.cache is not None and method == 'GET' else None
+        if ttl:
+            wait = sum(self.timeout)
+            if self.deadline is not None:
+                wait = min(wait, self.deadline - time.monotonic())
+            r = self.cache.fetch((self.username, self.base_url, uri), ttl, lambda: self._authenticated_request(method, uri, reauth, **kwargs),
+                                 refresh=not cached, wait=wait, cancelled=self.cancelled)
+            if getattr(r, 'from_cache', False):
+                with self.metrics.lock:
+                    self.metrics.cache_hits += 1
+            return r
+        return self._authenticated_request(method, uri, reauth, **kwargs)
+
+    def _authenticated_request(self, method, uri, reauth=True, **kwargs):
+        # Data calls go straight out; an expired session triggers one login and retry
+        login_count = self.login_count
+        r = self._send(method, uri, **kwargs)
+        if reauth and r.status_code in (401, 403):
+            self.authenticated = False
+            if self._relogin(login_count):
+                with self.metrics.lock:
+                    self.metrics.retries += 1
+                r = self._send(method, uri, **kwargs)
+        return r
+
+    def _relogin(self, login_count):
+        with self.login_lock:
+            # Another thread may have logged in while this request was running
+            if self.login_count != login_count:
+                return self.authenticated
+            with self.metrics.lock:
+                self.metrics.relogins += 1
+            return self.login()
+
+    def _send(self, method, uri, **kwargs):
+        if self.cancelled.is_set():
+            raise TelenetCancelled('Telenet client is cancelled')
+        connect_timeout, read_timeout = self.timeout
+        if self.deadline is not None:
+            remaining = self.deadline - time.monotonic()
+            if remaining <= 0:
+                raise requests.exceptions.Timeout('Telenet cycle budget exhausted')
+            connect_timeout, read_timeout = min(connect_timeout, remaining), min(read_timeout, remaining)
+        start = time.monotonic()
+        try:
+            r = self.s.request(method, '{}{}'.format(self.base_url, uri), timeout=(connect_timeout, read_timeout), **kwargs)
+            self.metrics.record(uri, time.monotonic() - start, r.status_code, len(r.content))
+            return r
+        except requests.exceptions.RequestException:
+            self.metrics.record(uri, time.monotonic() - start)
+            if self.cancelled.is_set():
+                raise TelenetCancelled('Telenet request cancelled')
+            raise
+
+    def export_session(self):
+        # Serialize cookie jar and XSRF header (obfuscated with the credentials)
+        cookies = [ { 'name': c.name, 'value': c.value, 'domain': c.domain, 'path': c.path,
+                      'expires': c.expires, 'secure': c.secure } for c in self.s.cookies ]
+        session = { 'version': TELENET_SESSION_VERSION,
+                    'username': self.username,
+                    'xsrf': self.s.headers.get('X-TOKEN-XSRF'),
+                    'cookies': cookies }
+        return _obfuscate(json.dumps(session), self._session_key())
+
+    def import_session(self, blob):
+        # Restore a session created by export_session(); login() will then only probe userdetails
+        if not blob:
+            return False
         try:
-            r = self.s.get('{}{}'.format(TELENET, TELENET_URI_SUBSCRIPTIONS))
+            session = json.loads(_deobfuscate(blob, self._session_key()))
         except:
             return False
+        if session.get('version') != TELENET_SESSION_VERSION or session.get('username') != self.username:
+            return False
+        for cookie in session['cookies']:
+            self.s.cookies.set(cookie['name'], cookie['value'], domain=cookie['domain'], path=cookie['path'],
+                               expires=cookie['expires'], secure=cookie['secure'])
+        if session['xsrf']:
+            self.s.headers['X-TOKEN-XSRF'] = session['xsrf']
+        return True
+
+    def _session_key(self):
+        return hashlib.sha256('{}:{}'.format(self.username, self.password).encode('utf-8')).digest()
+        
+    def _get_product_subscriptions(self, cached=True):
+        try:
+            r = self._request('GET', TELENET_URI_SUBSCRIPTIONS, cached=cached)
+        except:
+            return None
         if r.status_code == 200:
-            for subscription in r.json():
-                contract = { 'addressId' : subscription['addressId'],
-                             'businessidentifier' : subscription['identifier'],
-                             'total_usage_gb' : 0 }
-                address = self._get_address_from_id(subscription['addressId'])
-                if address:
-                    contract.update(address)
-                self.telemeter_info.append(contract)
-            return True
-        return False
+            subscriptions = r.json()
+            addresses = {}
+            for subscription in subscriptions:
+                # Several subscriptions often share the same address
+                if subscription['addressId'] not in addresses:
+                    addresses[subscription['addressId']] = self._get_address_from_id(subscription['addressId'])
+                if not addresses[subscription['addressId']]:
+                    # Incomplete metadata counts as a failed refresh
+                    return None
+            # Known contracts (and their usage) are kept, new ones are added and ended ones dropped
+            contracts = {}
+            for subscription in subscriptions:
+                contract = (self.contracts or {}).get(subscription['identifier']) or Contract(subscription['identifier'])
+                contract.addressId = subscription['addressId']
+                contract.set_address(addresses[subscription['addressId']])
+                contracts[contract.businessidentifier] = contract
+            return contracts
+        return None
         
     def _get_address_from_id(self, addressId):
         try:
-            r = self.s.get('{}{}'.format(TELENET, TELENET_URI_ADDRESS.format(addressId)))
+            r = self._request('GET', TELENET_URI_ADDRESS.format(addressId))
         except:
             return {}
         if r.status_code == 200:
@@ -121,13 +577,13 @@ class Telenet():
         
     def _get_contract_addresses(self):
         try:
-            r = self.s.get('{}{}'.format(TELENET, TELENET_URI_CUSTOMERS))
+            r = self._request('GET', TELENET_URI_CUSTOMERS)
         except:
             return False
         if r.status_code == 200:
             data = r.json()
             for address in data['customerLocations']:
-                r = self.s.get('{}{}'.format(TELENET, TELENET_URI_CONTRACT_ADDRESSES.format(address['address']['id'])))
+                r = self._request('GET', TELENET_URI_CONTRACT_ADDRESSES.format(address['address']['id']))
                 if r.status_code == 200:
                     data = r.json()
                 else:
@@ -135,32 +591,81 @@ class Telenet():
             return True
         return False
             
-    def _get_last_period(self, identifier):
+    def _get_last_period(self, identifier, force=False):
+        # The CURRENT billing cycle only changes once it has ended
+        cycle = self.billing_cycles.get(identifier)
+        if not force and cycle and not _cycle_ended(cycle['endDate']):
+            return 'fromDate={}&toDate={}'.format(cycle['startDate'], cycle['endDate'])
         try:
-            r = self.s.get('{}{}'.format(TELENET, TELENET_URI_BILLING_CYCLE.format(identifier)))
+            r = self._request('GET', TELENET_URI_BILLING_CYCLE.format(identifier), cached=not force)
         except:
             return None
         if r.status_code == 200:
-            data = r.json()
-            for billperiod in data['billCycles']:
-                if billperiod['billCycle'] == 'CURRENT':
-                    return 'fromDate={}&toDate={}'.format(billperiod['startDate'], billperiod['endDate'])
+            try:
+                data = r.json()
+                previous = [ { 'startDate': billperiod['startDate'], 'endDate': billperiod['endDate'] } for billperiod in data['billCycles'] if billperiod['billCycle'] != 'CURRENT' ]
+                for billperiod in data['billCycles']:
+                    if billperiod['billCycle'] == 'CURRENT':
+                        self.billing_cycles[identifier] = { 'startDate': billperiod['startDate'], 'endDate': billperiod['endDate'], 'previous': previous }
+                        return 'fromDate={}&toDate={}'.format(billperiod['startDate'], billperiod['endDate'])
+            except (ValueError, KeyError, TypeError):
+                # An unexpected response only fails this contract
+                pass
+        self.billing_cycles.pop(identifier, None)
         return None
 
+def _parse_daily_usage(data):
+    # [(YYYY-MM-DD, GB), ...] from the daily breakdown of a usage response. The breakdown is not
+    # documented by Telenet; the expected shape (also served by benchmarks/mock_telenet.py) is
+    #   { "internet": { "totalUsage": { "units": 12.3, "unitType": "GB" },
+    #                   "dailyUsages": [ { "date": "2024-05-01T00:00:00.000+02:00",
+    #                                      "usage": { "units": 1.2, "unitType": "GB" } }, ... ] } }
+    # with "units" also accepted directly on the day. Other days are skipped and an unknown shape
+    # gives an empty list (the caller logs that there is nothing to backfill).
+    daily_usage = []
+    for day in data['internet'].get('dailyUsages') or []:
+        try:
+            daily_usage.append((day['date'][:10], float(day.get('usage', day)['units'])))
+        except (KeyError, TypeError, ValueError):
+            pass
+    return sorted(daily_usage)
+
+def _cycle_ended(endDate):
+    try:
+        return datetime.date.fromisoformat(endDate[:10]) < datetime.date.today()
+    except (TypeError, ValueError):
+        return True
+
+def _keystream(key, length):
+    stream = b''
+    counter = 0
+    while len(stream) < length:
+        stream += hashlib.sha256(key + counter.to_bytes(4, 'big')).digest()
+        counter += 1
+    return stream[:length]
+
+def _obfuscate(text, key):
+    data = text.encode('utf-8')
+    return base64.urlsafe_b64encode(bytes(a ^ b for a, b in zip(data, _keystream(key, len(data))))).decode('ascii')
+
+def _deobfuscate(blob, key):
+    data = base64.urlsafe_b64decode(blob.encode('ascii'))
+    return bytes(a ^ b for a, b in zip(data, _keystream(key, len(data)))).decode('utf-8')
+
 if __name__ == "__main__":
 
-    telenet = Telenet(xxxx, yyyy)
+    import sys
+    if len(sys.argv) < 3:
+        print('Usage: {} username password [base_url] [cache_folder]'.format(sys.argv[0]))
+        sys.exit(1)
+    telenet = Telenet(sys.argv[1], sys.argv[2], base_url=sys.argv[3] if len(sys.argv) > 3 else None, cache_folder=sys.argv[4] if len(sys.argv) > 4 else None)
     for i in range(5):
-        if telenet.login():
-            print('Login successful')
-            if telenet.get_user_data():
-                print('Contacts found')
-                if telenet.telemeter():
-                    for product in telenet.telemeter_info:
-                        print(product)
-            else: 
-                print('No user data found.')
-        else:
-            print('Login failed')
+        if telenet.get_user_data():
+            print('Contacts found')
+            telenet.telemeter()
+            for product in telenet.telemeter_info:
+                print(product)
+        else: 
+            print('No user data found.')
         
 
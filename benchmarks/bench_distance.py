@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+"""
+Benchmark of the batch distance functions in domoticz_tools.
+
+Compares calling getDistance in a loop with getDistances (one origin to N
+points) and getDistanceMatrix (all pairs of about sqrt(N) points), with
+NumPy and with the pure Python fallback. Every batch result is checked
+against the scalar function.
+
+    python bench_distance.py --points 1000 100000 --seconds 0.5
+"""
+
+import argparse
+import math
+import os
+import random
+import sys
+import time
+
+HERE = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.join(HERE, 'emulator'))
+sys.path.insert(0, os.path.dirname(HERE))
+import domoticz_tools
+from domoticz_tools import getDistance, getDistances, getDistanceMatrix
+
+TOLERANCE = 1e-9           # relative difference allowed with getDistance
+
+
+def repeat(function, seconds):
+    # Calls function until the time budget is used; returns seconds per call
+    calls, start = 0, time.perf_counter()
+    while True:
+        function()
+        calls += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= seconds:
+            return elapsed / calls
+
+def points(count):
+    return [ (random.uniform(-90, 90), random.uniform(-180, 180)) for i in range(count) ]
+
+def check(expected, actual):
+    # Largest relative difference; fails when above the tolerance
+    error = max((abs(a - e) / max(abs(e), 1e-12) for e, a in zip(expected, actual)), default=0.0)
+    assert len(expected) == len(actual) and error <= TOLERANCE, 'batch result differs from getDistance: {}'.format(error)
+    return error
+
+def run(counts, seconds):
+    getNumpy = domoticz_tools._getNumpy
+    numpy_module = getNumpy()
+    backends = [ ('python', None) ] + ([ ('numpy', numpy_module) ] if numpy_module is not None else [])
+    print('{:>8} {:<7} {:<8} {:>11} {:>12} {:>9} {:>10}'.format('points', 'batch', 'backend', 'ms', 'points/s', 'speedup', 'max error'))
+    for count in counts:
+        origin, destinations = points(1)[0], points(count)
+        side = max(1, int(round(math.sqrt(count))))
+        grid = points(side)
+        expected = { 'one': [ getDistance(origin, destination) for destination in destinations ],
+                     'pairs': [ getDistance(a, b) for a in grid for b in grid ] }
+        batches = { 'one': (lambda: [ getDistance(origin, destination) for destination in destinations ], lambda: getDistances(origin, destinations)),
+                    'pairs': (lambda: [ [ getDistance(a, b) for b in grid ] for a in grid ], lambda: getDistanceMatrix(grid)) }
+        for batch, (scalar, vectorized) in batches.items():
+            total = len(expected[batch])
+            reference = repeat(scalar, seconds)
+            print('{:>8} {:<7} {:<8} {:>11.2f} {:>12,.0f} {:>9} {:>10}'.format(total, batch, 'scalar', reference*1000, total/reference, '1.0x', '-'))
+            for backend, module in backends:
+                domoticz_tools._getNumpy = lambda: module
+                try:
+                    result = vectorized()
+                    error = check(expected[batch], result if batch == 'one' else [ d for row in result for d in row ])
+                    elapsed = repeat(vectorized, seconds)
+                finally:
+                    domoticz_tools._getNumpy = getNumpy
+                print('{:>8} {:<7} {:<8} {:>11.2f} {:>12,.0f} {:>8.1f}x {:>10.1e}'.format(total, batch, backend, elapsed*1000, total/elapsed,
+                                                                                       reference/elapsed, error))
+    if numpy_module is None:
+        print('NumPy is not installed: only the pure Python fallback was measured')
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Benchmark the batch distance functions of domoticz_tools')
+    parser.add_argument('--points', type=int, nargs='+', default=[1000, 100000], help='number of distances per batch')
+    parser.add_argument('--seconds', type=float, default=0.5, help='time per measurement')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    run(args.points, args.seconds)
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+"""
+Startup benchmark of the Telenet plugin inside an emulated Domoticz.
+
+Every run is a fresh interpreter that measures the time from importing
+plugin.py to onStart returning (the part Domoticz waits for), and the time
+until the worker thread has imported Telenet/requests and finished the
+first Login task against the local mock API.
+
+    python bench_startup.py --runs 10 --devices 20
+"""
+
+import argparse
+import importlib.abc
+import importlib.machinery
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.realpath(__file__))
+
+
+class RedirectTelenet(importlib.abc.MetaPathFinder):
+    # Points the lazily imported Telenet module to the mock API once it is loaded
+
+    def __init__(self, base_url):
+        self.base_url = base_url
+
+    def find_spec(self, name, path=None, target=None):
+        if name != 'Telenet':
+            return None
+        spec = importlib.machinery.PathFinder.find_spec(name, path)
+        exec_module, base_url = spec.loader.exec_module, self.base_url
+        def exec_and_redirect(module):
+            exec_module(module)
+            module.TELENET = base_url
+        spec.loader.exec_module = exec_and_redirect
+        return spec
+
+def child(base_url, home_folder, devices):
+    # One measurement in this (fresh) interpreter, printed as JSON
+    sys.path.insert(0, os.path.join(HERE, 'emulator'))
+    sys.path.insert(0, os.path.dirname(HERE))
+    import Domoticz
+    sys.meta_path.insert(0, RedirectTelenet(base_url))
+    Domoticz.Parameters.update({ 'Name': 'Telenet', 'HomeFolder': home_folder, 'Mode1': 'user', 'Mode2': 'pass', 'Mode3': '',
+                                 'Mode4': 'False', 'Mode5': '1', 'Mode6': 'Normal' })
+    # Devices of a previous run
+    Domoticz.Images['Telenet'] = Domoticz.Image('Telenet.zip')
+    for unit in range(1, devices + 1):
+        Domoticz.Device(Name='Device {}'.format(unit), Unit=unit, TypeName='Custom').Create()
+
+    start = time.perf_counter()
+    import plugin
+    imported = time.perf_counter()
+    plugin.Parameters, plugin.Devices, plugin.Images = Domoticz.Parameters, Domoticz.Devices, Domoticz.Images
+    plugin.onStart()
+    started = time.perf_counter()
+    requests_loaded = 'requests' in sys.modules
+    plugin._plugin.tasksQueue.join(timeout=60)
+    ready = time.perf_counter()
+    plugin.onStop()
+    print(json.dumps({ 'import_ms': (imported - start)*1000, 'onstart_ms': (started - imported)*1000, 'total_ms': (started - start)*1000,
+                       'ready_ms': (ready - start)*1000, 'requests_at_return': requests_loaded,
+                       'timed_out': sum(1 for device in Domoticz.Devices.values() if device.TimedOut),
+                       'errors': Domoticz.Counters['Error'] }))
+
+def run(runs, devices):
+    from bench_telenet import MockServer
+    server = MockServer(1, 0.0, 0.0)
+    results = []
+    try:
+        for i in range(runs):
+            home_folder = tempfile.mkdtemp(prefix='telenet-startup-') + os.sep
+            try:
+                output = subprocess.run([ sys.executable, os.path.realpath(__file__), '--child', server.base_url, home_folder, str(devices) ],
+                                        stdout=subprocess.PIPE, text=True, check=True).stdout
+                results.append(json.loads(output.splitlines()[-1]))
+            finally:
+                shutil.rmtree(home_folder, ignore_errors=True)
+    finally:
+        server.close()
+    return results
+
+def report(results):
+    print('{} runs'.format(len(results)))
+    print('{:<34} {:>9} {:>9} {:>9}'.format('', 'median', 'min', 'max'))
+    for key, label in (('import_ms', 'import plugin.py (ms)'), ('onstart_ms', 'onStart (ms)'),
+                       ('total_ms', 'import to onStart return (ms)'), ('ready_ms', 'import to first Login done (ms)')):
+        values = [ result[key] for result in results ]
+        print('{:<34} {:>9.1f} {:>9.1f} {:>9.1f}'.format(label, statistics.median(values), min(values), max(values)))
+    print('requests imported when onStart returned: {}/{} runs'.format(sum(result['requests_at_return'] for result in results), len(results)))
+    print('devices timed out at startup: {}, errors: {}'.format(max(result['timed_out'] for result in results), sum(result['errors'] for result in results)))
+
+
+if __name__ == "__main__":
+
+    if len(sys.argv) == 5 and sys.argv[1] == '--child':
+        child(sys.argv[2], sys.argv[3], int(sys.argv[4]))
+        sys.exit(0)
+
+    parser = argparse.ArgumentParser(description='Benchmark the startup of the Telenet plugin in an emulated Domoticz')
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--devices', type=int, default=20, help='devices of a previous run present at startup')
+    args = parser.parse_args()
+
+    report(run(args.runs, args.devices))
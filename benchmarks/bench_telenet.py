@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+"""
+Offline benchmark of the Telenet client against the local mock API.
+
+Reports round trips, wall time, CPU time and peak memory of login(),
+get_user_data() and telemeter() for cold starts, warm polls and restarts
+with a persisted session, and for a second instance reading the shared
+response cache.
+
+    python bench_telenet.py --contracts 1 4 16 --latency 0.05
+    python bench_telenet.py --save baseline.json
+    python bench_telenet.py --compare baseline.json
+"""
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+HERE = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+import Telenet
+
+USERNAME = 'user'
+PASSWORD = 'pass'
+
+
+class MockServer():
+    # The mock runs in its own process so that its CPU time is not measured
+
+    def __init__(self, contracts, latency, error_rate, accounts=1):
+        self.process = subprocess.Popen([ sys.executable, '-u', os.path.join(HERE, 'mock_telenet.py'), '--port', '0',
+                                          '--contracts', str(contracts), '--latency', str(latency), '--error-rate', str(error_rate),
+                                          '--accounts', str(accounts),
+                                          '--username', USERNAME, '--password', PASSWORD ], stdout=subprocess.PIPE, text=True)
+        line = self.process.stdout.readline()
+        self.base_url = line.split()[4]
+
+    def close(self):
+        self.process.terminate()
+        self.process.wait()
+
+
+def measure(name, function):
+    round_trips = lambda client: sum(endpoint['requests'] for endpoint in client.metrics.snapshot()['endpoints'].values())
+    client = function.__self__
+    before = round_trips(client)
+    tracemalloc.start()
+    wall, cpu = time.perf_counter(), time.process_time()
+    result = function()
+    wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    # telemeter() returns the changed contracts: success is the usage_ok of every contract
+    ok = all(contract.usage_ok for contract in client.telemeter_info) if isinstance(result, list) else bool(result)
+    return { 'name': name, 'ok': ok,
+             'round_trips': round_trips(client) - before, 'wall_ms': wall*1000, 'cpu_ms': cpu*1000, 'peak_kb': peak/1024 }
+
+def run(contracts, latency, error_rate, polls):
+    server = MockServer(contracts, latency, error_rate)
+    results = []
+    try:
+        # Cold start: full OAuth login and metadata
+        client = Telenet.Telenet(USERNAME, PASSWORD, base_url=server.base_url)
+        results.append(measure('cold login', client.login))
+        results.append(measure('cold get_user_data', client.get_user_data))
+        results.append(measure('cold telemeter', client.telemeter))
+
+        # Warm polls as done by the plugin for every GetInternetVolume task
+        for i in range(polls):
+            client.start_cycle()
+            warm = [ measure('warm get_user_data', client.get_user_data), measure('warm telemeter', client.telemeter) ]
+            results.extend(warm)
+        session, cycles = client.export_session(), dict(client.billing_cycles)
+        client.close()
+
+        # Restart with the persisted session and billing cycles
+        client = Telenet.Telenet(USERNAME, PASSWORD, base_url=server.base_url)
+        client.import_session(session)
+        client.billing_cycles = cycles
+        results.append(measure('restart login', client.login))
+        results.append(measure('restart get_user_data', client.get_user_data))
+        results.append(measure('restart telemeter', client.telemeter))
+        client.close()
+
+        # A second instance (not logged in) reads what the first one stored in the shared response cache
+        folder = tempfile.mkdtemp(prefix='telenet-cache-')
+        try:
+            for name in ('cache fill', 'cache hit'):
+                client = Telenet.Telenet(USERNAME, PASSWORD, base_url=server.base_url, cache_folder=folder)
+                client.start_cycle()
+                results.append(measure('{} user data'.format(name), client.get_user_data))
+                results.append(measure('{} telemeter'.format(name), client.telemeter))
+                client.close()
+        finally:
+            shutil.rmtree(folder, ignore_errors=True)
+    finally:
+        server.close()
+    return summarize(results)
+
+def summarize(results):
+    # Average repeated measurements with the same name
+    summary = {}
+    for result in results:
+        entry = summary.setdefault(result['name'], { 'runs': 0, 'ok': True, 'round_trips': 0, 'wall_ms': 0.0, 'cpu_ms': 0.0, 'peak_kb': 0.0 })
+        entry['runs'] += 1
+        entry['ok'] = entry['ok'] and result['ok']
+        for key in ('round_trips', 'wall_ms', 'cpu_ms', 'peak_kb'):
+            entry[key] += result[key]
+    for entry in summary.values():
+        for key in ('round_trips', 'wall_ms', 'cpu_ms', 'peak_kb'):
+            entry[key] /= entry['runs']
+    return summary
+
+def report(reports, baseline=None):
+    print('{:>9} {:<22} {:>3} {:>11} {:>10} {:>9} {:>10}'.format('contracts', 'operation', 'ok', 'round trips', 'wall ms', 'cpu ms', 'peak KiB'))
+    for contracts, summary in reports.items():
+        for name, entry in summary.items():
+            line = '{:>9} {:<22} {:>3} {:>11.1f} {:>10.1f} {:>9.2f} {:>10.1f}'.format(contracts, name, 'yes' if entry['ok'] else 'NO',
+                                                                                   entry['round_trips'], entry['wall_ms'], entry['cpu_ms'], entry['peak_kb'])
+            reference = (baseline or {}).get(contracts, {}).get(name)
+            if reference:
+                line += '   (round trips {:+.1f}, wall {:+.0%}, cpu {:+.0%})'.format(entry['round_trips'] - reference['round_trips'],
+                                                                               entry['wall_ms'] / reference['wall_ms'] - 1 if reference['wall_ms'] else 0,
+                                                                               entry['cpu_ms'] / reference['cpu_ms'] - 1 if reference['cpu_ms'] else 0)
+            print(line)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Benchmark the Telenet client against the local mock API')
+    parser.add_argument('--contracts', type=int, nargs='+', default=[1, 4, 16])
+    parser.add_argument('--latency', type=float, default=0.02, help='mock latency per request in seconds')
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--polls', type=int, default=5, help='number of warm polls to average')
+    parser.add_argument('--save', help='write the results as JSON baseline')
+    parser.add_argument('--compare', help='compare with a JSON baseline')
+    args = parser.parse_args()
+
+    reports = { str(contracts): run(contracts, args.latency, args.error_rate, args.polls) for contracts in args.contracts }
+    baseline = None
+    if args.compare:
+        with open(args.compare) as infile:
+            baseline = json.load(infile)
+    report(reports, baseline)
+    if args.save:
+        with open(args.save, 'w') as outfile:
+            json.dump(reports, outfile, indent=1)
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+"""
+Throughput benchmark of the WebSocket frame codec in domoticz_tools.
+
+Encodes and decodes streams of small and large frames, unmasked (server to
+client) and masked (client to server). The decoder is fed in chunks as
+they would come from a socket. Small unmasked frames are also encoded with
+the previous hex-string encoder for reference.
+
+    python bench_websocket.py --sizes 16 125 1024 65536 1048576 --seconds 0.5
+"""
+
+import argparse
+import os
+import sys
+import time
+
+HERE = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.join(HERE, 'emulator'))
+sys.path.insert(0, os.path.dirname(HERE))
+from domoticz_tools import FormatWebSocketFrame, WebSocketParser, WS_BINARY
+
+CHUNK = 64*1024            # bytes per simulated socket read
+
+
+def legacy_format(payload):
+    # Hex-string encoder that was used before (unmasked, payloads below 127 bytes)
+    formatted = ''
+    if len(payload) < 127:
+        formatted += '82'
+        formatted += '{:02X}'.format(len(payload))
+    return bytes.fromhex(formatted) + payload
+
+def repeat(function, seconds):
+    # Calls function until the time budget is used; returns (calls, elapsed)
+    calls, start = 0, time.perf_counter()
+    while True:
+        function()
+        calls += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= seconds:
+            return calls, elapsed
+
+def encode(size, mask, seconds, frames):
+    payload = os.urandom(size)
+    def batch():
+        for i in range(frames):
+            FormatWebSocketFrame(payload, WS_BINARY, Mask=mask)
+    calls, elapsed = repeat(batch, seconds)
+    return calls*frames/elapsed, calls*frames*size/elapsed
+
+def encode_legacy(size, seconds, frames):
+    payload = os.urandom(size)
+    def batch():
+        for i in range(frames):
+            legacy_format(payload)
+    calls, elapsed = repeat(batch, seconds)
+    return calls*frames/elapsed, calls*frames*size/elapsed
+
+def decode(size, mask, seconds, frames):
+    stream = b''.join(FormatWebSocketFrame(os.urandom(size), WS_BINARY, Mask=mask) for i in range(frames))
+    chunks = [ stream[start:start+CHUNK] for start in range(0, len(stream), CHUNK) ]
+    def batch():
+        parser = WebSocketParser()
+        count = 0
+        for chunk in chunks:
+            parser.Feed(chunk)
+            for opcode, payload in parser.Messages():
+                count += 1
+        assert count == frames
+    calls, elapsed = repeat(batch, seconds)
+    return calls*frames/elapsed, calls*frames*size/elapsed
+
+def run(sizes, seconds):
+    print('{:>9} {:<8} {:<8} {:>14} {:>12}'.format('size', 'masked', 'codec', 'frames/s', 'MB/s'))
+    for size in sizes:
+        # About 4 MiB of payload per batch, at least one frame
+        frames = max(1, min(10000, 4*1024*1024 // max(size, 1)))
+        rows = []
+        for mask in (None, True):
+            rows.append(('yes' if mask else 'no', 'encode') + encode(size, mask, seconds, frames))
+            rows.append(('yes' if mask else 'no', 'decode') + decode(size, mask, seconds, frames))
+        if size < 127:
+            rows.append(('no', 'legacy') + encode_legacy(size, seconds, frames))
+        for masked, codec, rate, throughput in rows:
+            print('{:>9} {:<8} {:<8} {:>14,.0f} {:>12.1f}'.format(size, masked, codec, rate, throughput/1e6))
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Benchmark the WebSocket frame codec of domoticz_tools')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[16, 125, 1024, 65536, 1048576], help='payload sizes in bytes')
+    parser.add_argument('--seconds', type=float, default=0.5, help='time per measurement')
+    args = parser.parse_args()
+
+    run(args.sizes, args.seconds)
@@ -0,0 +1,135 @@
+"""
+Emulation of the Domoticz plugin runtime module for simulations outside Domoticz.
+
+Provides the logging functions, Configuration(), Image and Device. The
+Parameters, Devices and Images dictionaries of this module are injected in
+the plugin module by the simulation driver (like Domoticz does).
+"""
+
+import datetime
+import threading
+
+Parameters = {}
+Devices = {}
+Images = {}
+
+_Configuration = {}
+_Debugging = 0
+_Lock = threading.Lock()
+_Log = []
+_LogSize = 1000
+Counters = { 'Debug': 0, 'Log': 0, 'Status': 0, 'Error': 0, 'Create': 0, 'Update': 0, 'Touch': 0, 'Configuration': 0 }
+Echo = False
+Clock = None               # function returning the (virtual) time, used for LastUpdate
+
+
+def _log(level, message):
+    with _Lock:
+        Counters[level] += 1
+        _Log.append((level, message))
+        del _Log[:-_LogSize]
+    if Echo and (level != 'Debug' or _Debugging):
+        print('{}: {}'.format(level, message))
+
+def Debug(message):
+    _log('Debug', message)
+
+def Log(message):
+    _log('Log', message)
+
+def Status(message):
+    _log('Status', message)
+
+def Error(message):
+    _log('Error', message)
+
+def Debugging(mode):
+    global _Debugging
+    _Debugging = mode
+
+def Messages(level=None):
+    with _Lock:
+        return [ message for entry_level, message in _Log if level in (None, entry_level) ]
+
+def Configuration(Config=None):
+    global _Configuration
+    with _Lock:
+        Counters['Configuration'] += 1
+        if Config is not None:
+            _Configuration = dict(Config)
+        return dict(_Configuration)
+
+def _now():
+    return datetime.datetime.fromtimestamp(Clock()) if Clock else datetime.datetime.now()
+
+
+class Image():
+
+    def __init__(self, Filename):
+        self.Filename = Filename
+        self.Base = Filename.rsplit('.', 1)[0]
+        self.ID = len(Images) + 1
+        self.Name = self.Base
+
+    def Create(self):
+        Images[self.Base] = self
+
+
+class Device():
+
+    def __init__(self, Name='', Unit=0, TypeName='', Type=0, Subtype=0, Switchtype=0, Image=0, Options={}, Used=0, DeviceID='', Description=''):
+        self.Name = '{} - {}'.format(Parameters.get('Name', 'Plugin'), Name)
+        self.Unit = Unit
+        self.TypeName = TypeName
+        self.Type = Type
+        self.SubType = Subtype
+        self.SwitchType = Switchtype
+        self.Image = Image
+        self.Options = dict(Options)
+        self.Used = Used
+        self.DeviceID = DeviceID or str(Unit)
+        self.Description = Description
+        self.ID = 0
+        self.nValue = 0
+        self.sValue = ''
+        self.TimedOut = 0
+        self.LastLevel = 0
+        self.BatteryLevel = 255
+        self.SignalLevel = 12
+        self.LastUpdate = _now().strftime('%Y-%m-%d %H:%M:%S')
+        self.Updates = 0
+        self.Touches = 0
+
+    def __str__(self):
+        return 'Unit: {}, Name: \'{}\', nValue: {}, sValue: \'{}\''.format(self.Unit, self.Name, self.nValue, self.sValue)
+
+    def Create(self):
+        if self.Unit in Devices:
+            Error('Device creation failed, unit {} already exists.'.format(self.Unit))
+            return
+        with _Lock:
+            Counters['Create'] += 1
+        self.ID = 1000 + self.Unit
+        Devices[self.Unit] = self
+
+    def Update(self, nValue, sValue, **kwargs):
+        with _Lock:
+            Counters['Update'] += 1
+        self.Updates += 1
+        self.nValue = nValue
+        self.sValue = sValue
+        self.TimedOut = kwargs.pop('TimedOut', 0)
+        for key, value in kwargs.items():
+            if key == 'Name':
+                value = '{} - {}'.format(Parameters.get('Name', 'Plugin'), value)
+            setattr(self, key, value)
+        self.LastUpdate = _now().strftime('%Y-%m-%d %H:%M:%S')
+
+    def Touch(self):
+        with _Lock:
+            Counters['Touch'] += 1
+        self.Touches += 1
+        self.LastUpdate = _now().strftime('%Y-%m-%d %H:%M:%S')
+
+    def Delete(self):
+        Devices.pop(self.Unit, None)
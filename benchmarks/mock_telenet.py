@@ -0,0 +1,257 @@
+#!/usr/bin/env python
+"""
+Local stand-in for the Telenet API used by the benchmarks.
+
+Replays the JSON fixtures in the fixtures folder for every TELENET_URI_*
+endpoint (OAuth handshake, subscriptions, addresses, billcycle and usage)
+for any number of accounts and contracts, with configurable latency and
+error injection. Accounts after the first one log in as user2, user3, ...
+with the same password.
+
+Run standalone:  python mock_telenet.py --contracts 4 --latency 0.05
+and point the client to it:  python ../Telenet.py user pass http://127.0.0.1:8080
+"""
+
+import argparse
+import datetime
+import json
+import os
+import random
+import re
+import secrets
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+FIXTURES = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'fixtures')
+
+ROUTES = [ ('OAUTH',          'GET',  r'^/ocapi/oauth/userdetails$'),
+           ('LOGIN',          'GET',  r'^/openid/oauth/authorize$'),
+           ('DO_LOGIN',       'POST', r'^/openid/login\.do$'),
+           ('SUBSCRIPTIONS',  'GET',  r'^/ocapi/public/api/product-service/v1/product-subscriptions$'),
+           ('ADDRESS',        'GET',  r'^/ocapi/public/api/contact-service/v1/contact/addresses/(?P<addressId>[^/]+)$'),
+           ('BILLING_CYCLE',  'GET',  r'^/ocapi/public/api/billing-service/v1/account/products/(?P<identifier>[^/]+)/billcycle-details$'),
+           ('INTERNET_USAGE', 'GET',  r'^/ocapi/public/api/product-service/v1/products/internet/(?P<identifier>[^/]+)/usage$') ]
+
+def load_fixture(name):
+    with open(os.path.join(FIXTURES, '{}.json'.format(name))) as infile:
+        return json.load(infile)
+
+def render(template, values):
+    # Replace "{key}" strings by the value (of any type) and substitute "{key}" inside longer strings
+    if isinstance(template, dict):
+        return { key: render(value, values) for key, value in template.items() }
+    if isinstance(template, list):
+        return [ render(value, values) for value in template ]
+    if isinstance(template, str):
+        match = re.fullmatch(r'\{(\w+)\}', template)
+        if match and match.group(1) in values:
+            return values[match.group(1)]
+        return re.sub(r'\{(\w+)\}', lambda m: str(values.get(m.group(1), m.group(0))), template)
+    return template
+
+
+class MockTelenet():
+
+    def __init__(self, contracts=1, latency=0.0, error_rate=0.0, expire_after=None, username='user', password='pass', seed=None, accounts=1):
+        self.contracts = contracts
+        self.accounts = accounts
+        self.latency = latency
+        self.error_rate = error_rate
+        self.expire_after = expire_after          # invalidate sessions after this many authenticated requests
+        self.username = username
+        self.password = password
+        self.random = random.Random(seed)
+        self.fixtures = { name: load_fixture(name) for name in ('userdetails', 'subscription', 'address', 'billcycle', 'usage') }
+        self.lock = threading.Lock()
+        self.sessions = {}
+        self.owners = {}                          # session token: account
+        self.counts = {}
+        self.server = None
+        self.thread = None
+
+    # Contract data: two contracts share every address to exercise address deduplication
+    def identifier(self, index, account=0):
+        return 'internet{:06d}'.format(account*1000 + index)
+
+    def address_id(self, index, account=0):
+        return str(1000 + account*1000 + index // 2)
+
+    def account(self, username):
+        for account in range(self.accounts):
+            if username == (self.username if account == 0 else '{}{}'.format(self.username, account + 1)):
+                return account
+        return None
+
+    def cycle(self, months_back=0):
+        today = datetime.date.today()
+        year, month = today.year, today.month - months_back
+        while month < 1:
+            year, month = year - 1, month + 12
+        start = datetime.date(year, month, 1)
+        end = (start + datetime.timedelta(days=32)).replace(day=1) - datetime.timedelta(days=1)
+        return start, end
+
+    def daily_usages(self, identifier, start, end):
+        seed = int(identifier[-6:])
+        days = (min(end, datetime.date.today()) - start).days + 1
+        return [ { 'date': (start + datetime.timedelta(days=day)).isoformat(),
+                   'usage': { 'units': round(1.5 + (seed + day) % 7 * 0.75, 3), 'unitType': 'GB' } } for day in range(days) ]
+
+    def start(self, host='127.0.0.1', port=0):
+        mock = self
+        class Handler(MockHandler):
+            pass
+        Handler.mock = mock
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(name='MockTelenet', target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    @property
+    def base_url(self):
+        return 'http://{}:{}'.format(*self.server.server_address[:2])
+
+    def reset_counts(self):
+        with self.lock:
+            self.counts = {}
+
+    def round_trips(self):
+        with self.lock:
+            return sum(self.counts.values())
+
+    def expire_sessions(self):
+        with self.lock:
+            self.sessions = {}
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    mock = None
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.handle_request('GET')
+
+    def do_POST(self):
+        self.handle_request('POST')
+
+    def handle_request(self, method):
+        mock = self.mock
+        url = urlsplit(self.path)
+        query = parse_qs(url.query)
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0) or 0))
+        for name, route_method, pattern in ROUTES:
+            match = re.match(pattern, url.path)
+            if match and method == route_method:
+                break
+        else:
+            return self.reply(404, {'error': 'unknown endpoint'})
+
+        with mock.lock:
+            mock.counts[name] = mock.counts.get(name, 0) + 1
+        if mock.latency:
+            time.sleep(mock.latency)
+        if mock.error_rate and name not in ('LOGIN', 'DO_LOGIN') and mock.random.random() < mock.error_rate:
+            return self.reply(500, {'error': 'injected'})
+
+        if name == 'LOGIN':
+            return self.reply(200, 'login page', content_type='text/html')
+        if name == 'DO_LOGIN':
+            form = parse_qs(body.decode('utf-8'))
+            account = mock.account(form.get('j_username', [''])[0])
+            if account is None or form.get('j_password') != [mock.password]:
+                return self.reply(401, 'invalid credentials', content_type='text/html')
+            token, xsrf = secrets.token_hex(16), secrets.token_hex(8)
+            with mock.lock:
+                mock.sessions[token] = 0
+                mock.owners[token] = account
+            return self.reply(200, 'ok', content_type='text/html', cookies={'SESSION': token, 'TOKEN-XSRF': xsrf})
+
+        account = self.authenticated()
+        if account is None:
+            if name == 'OAUTH':
+                return self.reply(401, '{},{}'.format(secrets.token_hex(8), secrets.token_hex(8)), content_type='text/plain')
+            return self.reply(401, {'error': 'unauthorized'})
+
+        fixtures = mock.fixtures
+        if name == 'OAUTH':
+            return self.reply(200, render(fixtures['userdetails'], {'customer': str(123456789 + account), 'username': mock.username}))
+        if name == 'SUBSCRIPTIONS':
+            return self.reply(200, [ render(fixtures['subscription'], {'identifier': mock.identifier(i, account), 'addressId': mock.address_id(i, account)}) for i in range(mock.contracts) ])
+        if name == 'ADDRESS':
+            return self.reply(200, render(fixtures['address'], match.groupdict()))
+        if name == 'BILLING_CYCLE':
+            values = {}
+            for prefix, months_back in (('current', 0), ('previous', 1), ('older', 2)):
+                start, end = mock.cycle(months_back)
+                values['{}Start'.format(prefix)], values['{}End'.format(prefix)] = start.isoformat(), end.isoformat()
+            return self.reply(200, render(fixtures['billcycle'], values))
+        if name == 'INTERNET_USAGE':
+            try:
+                start = datetime.date.fromisoformat(query['fromDate'][0][:10])
+                end = datetime.date.fromisoformat(query['toDate'][0][:10])
+            except (KeyError, ValueError):
+                return self.reply(400, {'error': 'invalid period'})
+            if (start, end) not in (mock.cycle(0), mock.cycle(1), mock.cycle(2)):
+                return self.reply(400, {'error': 'period out of range'})
+            daily = mock.daily_usages(match.group('identifier'), start, end)
+            total = round(sum(day['usage']['units'] for day in daily), 3)
+            return self.reply(200, render(fixtures['usage'], {'totalUsage': total, 'dailyUsages': daily}))
+
+    def authenticated(self):
+        mock = self.mock
+        cookies = dict(cookie.strip().split('=', 1) for cookie in self.headers.get('Cookie', '').split(';') if '=' in cookie)
+        token = cookies.get('SESSION')
+        with mock.lock:
+            if token not in mock.sessions:
+                return None
+            mock.sessions[token] += 1
+            if mock.expire_after and mock.sessions[token] > mock.expire_after:
+                del mock.sessions[token]
+                return None
+            return mock.owners[token]
+
+    def reply(self, status, data, content_type='application/json', cookies={}):
+        payload = (json.dumps(data) if content_type == 'application/json' else data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(payload)))
+        for key, value in cookies.items():
+            self.send_header('Set-Cookie', '{}={}; Path=/'.format(key, value))
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Local mock of the Telenet API')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--contracts', type=int, default=1, help='contracts per account')
+    parser.add_argument('--accounts', type=int, default=1)
+    parser.add_argument('--latency', type=float, default=0.0, help='delay per request in seconds')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of data requests answered with HTTP 500')
+    parser.add_argument('--expire-after', type=int, default=None, help='expire sessions after this many requests')
+    parser.add_argument('--username', default='user')
+    parser.add_argument('--password', default='pass')
+    args = parser.parse_args()
+
+    mock = MockTelenet(args.contracts, args.latency, args.error_rate, args.expire_after, args.username, args.password, accounts=args.accounts).start(args.host, args.port)
+    print('Mock Telenet API on {} ({} contracts)'.format(mock.base_url, args.contracts*args.accounts))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        mock.stop()
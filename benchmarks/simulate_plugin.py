@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+"""
+Accelerated simulation of the Telenet plugin inside an emulated Domoticz.
+
+Runs onStart, then onHeartbeat on a virtual clock (one heartbeat per 10
+virtual seconds, as fast as the plugin allows) against the local mock API,
+and finally onStop. Reports CPU per heartbeat, thread counts, shutdown
+latency and device update counts.
+
+    python simulate_plugin.py --days 90 --contracts 2 --error-rate 0.05
+    python simulate_plugin.py --days 30 --accounts 3 --latency 0.05
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+HERE = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.join(HERE, 'emulator'))
+sys.path.insert(0, os.path.dirname(HERE))
+import Domoticz
+from bench_telenet import MockServer, USERNAME, PASSWORD
+
+HEARTBEAT = 10
+
+
+class VirtualClock():
+
+    def __init__(self, start=None):
+        self.now = start if start is not None else time.time()
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+def load_plugin(base_url, interval, home_folder, metrics_devices, debug=False, accounts=1):
+    import Telenet
+    Telenet.TELENET = base_url
+    import plugin
+    # Accounts of the mock: user, user2, user3, ... with the same password
+    usernames = [ USERNAME if account == 0 else '{}{}'.format(USERNAME, account + 1) for account in range(accounts) ]
+    Domoticz.Parameters.update({ 'Name': 'Telenet', 'HomeFolder': home_folder, 'Mode1': ';'.join(usernames), 'Mode2': ';'.join([PASSWORD]*accounts), 'Mode3': '',
+                                 'Mode4': 'True' if metrics_devices else 'False', 'Mode5': str(interval), 'Mode6': 'Debug' if debug else 'Normal' })
+    # Domoticz injects these dictionaries in the plugin module
+    plugin.Parameters, plugin.Devices, plugin.Images = Domoticz.Parameters, Domoticz.Devices, Domoticz.Images
+    return plugin
+
+def simulate(days, interval, contracts, latency, error_rate, metrics_devices, echo, debug=False, accounts=1):
+    server = MockServer(contracts, latency, error_rate, accounts)
+    home_folder = tempfile.mkdtemp(prefix='telenet-sim-') + os.sep
+    clock = VirtualClock()
+    Domoticz.Clock = clock
+    Domoticz.Echo = echo
+    try:
+        plugin = load_plugin(server.base_url, interval, home_folder, metrics_devices, debug, accounts)
+        plugin._plugin.clock = clock
+
+        cpu_start, wall_start = time.process_time(), time.perf_counter()
+        start = time.perf_counter()
+        plugin.onStart()
+        startup = time.perf_counter() - start
+        plugin._plugin.tasksQueue.join(timeout=60)
+
+        heartbeats = int(days * 24 * 3600 / HEARTBEAT)
+        heartbeat_cpu, heartbeat_max, thread_max, waits = 0.0, 0.0, threading.active_count(), 0
+        for i in range(heartbeats):
+            clock.advance(HEARTBEAT)
+            cpu = time.thread_time()
+            plugin.onHeartbeat()
+            cpu = time.thread_time() - cpu
+            heartbeat_cpu += cpu
+            heartbeat_max = max(heartbeat_max, cpu)
+            # Let the worker finish before the virtual clock moves on
+            if plugin._plugin.tasksQueue.unfinished:
+                waits += 1
+                thread_max = max(thread_max, threading.active_count())
+                plugin._plugin.tasksQueue.join(timeout=60)
+
+        metrics = [ account.client.metrics.snapshot() for account in plugin._plugin.Accounts ]
+        start = time.perf_counter()
+        plugin.onStop()
+        shutdown = time.perf_counter() - start
+        cpu_total, wall_total = time.process_time() - cpu_start, time.perf_counter() - wall_start
+    finally:
+        server.close()
+        shutil.rmtree(home_folder, ignore_errors=True)
+
+    print('Simulated {} days ({} heartbeats, {} accounts) in {:.1f}s wall, {:.1f}s CPU'.format(days, heartbeats, accounts, wall_total, cpu_total))
+    print('  startup (onStart)       {:.1f} ms'.format(startup*1000))
+    print('  heartbeat CPU           {:.1f} us mean, {:.1f} us max'.format(heartbeat_cpu/heartbeats*1e6 if heartbeats else 0, heartbeat_max*1e6))
+    print('  polls                   {} ({} requests, {} re-logins, {} retries)'.format(waits, sum(endpoint['requests'] for account in metrics for endpoint in account['endpoints'].values()),
+                                                                                     sum(account['relogins'] for account in metrics), sum(account['retries'] for account in metrics)))
+    print('  threads                 {} max during polls, {} after stop'.format(thread_max, threading.active_count()))
+    print('  shutdown (onStop)       {:.1f} ms'.format(shutdown*1000))
+    print('  devices                 {} (created {}, updates {}, touches {})'.format(len(Domoticz.Devices), Domoticz.Counters['Create'],
+                                                                                  Domoticz.Counters['Update'], Domoticz.Counters['Touch']))
+    print('  configuration writes    {}'.format(Domoticz.Counters['Configuration']))
+    print('  log                     {} errors, {} debug'.format(Domoticz.Counters['Error'], Domoticz.Counters['Debug']))
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Simulate the Telenet plugin in an emulated Domoticz')
+    parser.add_argument('--days', type=float, default=30)
+    parser.add_argument('--interval', type=float, default=1, help='hours between updates (Mode5)')
+    parser.add_argument('--contracts', type=int, default=1, help='contracts per account')
+    parser.add_argument('--accounts', type=int, default=1, help='accounts polled by the plugin (Mode1/Mode2)')
+    parser.add_argument('--latency', type=float, default=0.0, help='mock latency per request in seconds')
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--metrics-devices', action='store_true')
+    parser.add_argument('--echo', action='store_true', help='print the Domoticz log')
+    parser.add_argument('--debug', action='store_true', help='run the plugin in debug mode (Mode6)')
+    args = parser.parse_args()
+
+    simulate(args.days, args.interval, args.contracts, args.latency, args.error_rate, args.metrics_devices, args.echo, args.debug, args.accounts)
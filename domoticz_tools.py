@@ -6,18 +6,24 @@
 
 __all__ = ['TIMEDOUT', 'MINUTE', 'DEBUG_OFF', 'DEBUG_ON', 'DEBUG_ON_NO_FRAMEWORK',\
            'DumpConfigToLog', \
-           'GetNextFreeUnit', 'FindUnitFromName', 'FindUnitFromDescription', 'AddTagToDescription', 'GetTagFromDescription', 'UpdateDevice', 'GetDevicesValue', 'GetDevicenValue', 'UpdateDeviceBatSig', 'TimeoutDevice', 'TimeoutDevicesByName', 'UpdateDeviceOptions', 'SecondsSinceLastUpdate', \
-           'getConfigItemDB', 'setConfigItemDB', 'getConfigItemFile', 'setConfigItemFile', \
+           'GetNextFreeUnit', 'CreateDevice', 'FindUnitFromName', 'FindUnitFromDescription', 'FindUnitFromTag', 'AddTagToDescription', 'AddTagsToDescription', 'CreateDescription', 'GetTagFromDescription', 'GetTagsFromDescription', 'UpdateDevice', 'DeviceUpdateBatch', 'StartDeviceUpdates', 'FlushDeviceUpdates', 'GetDevicesValue', 'GetDevicenValue', 'UpdateDeviceBatSig', 'TimeoutDevice', 'TimeoutDevicesByName', 'UpdateDeviceOptions', 'SecondsSinceLastUpdate', \
+           'getConfigItemDB', 'setConfigItemDB', 'ConfigFileStore', 'getConfigItemFile', 'setConfigItemFile', 'flushConfigItemFile', \
            'getCPUtemperature', \
-           'FormatWebSocketMessage', 'FormatWebSocketPong', 'FormatWebSocketMessageDisconnect', \
-           'getDistance' \
+           'WS_CONTINUATION', 'WS_TEXT', 'WS_BINARY', 'WS_CLOSE', 'WS_PING', 'WS_PONG', 'WebSocketError', 'WebSocketParser', \
+           'FormatWebSocketFrame', 'FormatWebSocketMessage', 'FormatWebSocketPing', 'FormatWebSocketPong', 'FormatWebSocketMessageDisconnect', 'ParseWebSocketClose', \
+           'getDistance', 'getDistances', 'getDistanceMatrix' \
           ] 
 
 #IMPORTS
 import Domoticz
+import atexit
+import copy
 import datetime
 import json
 import os
+import struct
+import tempfile
+import threading
 
 #CONSTANTS
 TIMEDOUT = 1               # timeout
@@ -25,6 +31,8 @@ MINUTE = 6                 # heartbeat is every 10s
 DEBUG_OFF = 0              # set debug off
 DEBUG_ON = 1               # set debug on
 DEBUG_ON_NO_FRAMEWORK= 2   # set debug on but only message by Domoticz.Debug()
+_PLUGIN_PARAMETERS_FILE = 'plugin_parameters.json'   # configuration file in the home folder
+_CONFIG_WRITE_DELAY = 5    # seconds configuration file writes are held back to be merged
 
 #DUMP THE PARAMETER
 def DumpConfigToLog(Parameters, Devices):
@@ -38,73 +46,277 @@ def DumpConfigToLog(Parameters, Devices):
         Domoticz.Debug('Device {} Description: {}'.format(device, Devices[device].Description))
         Domoticz.Debug('Device {} LastLevel:   {}'.format(device, Devices[device].LastLevel))
 
+#INDEX OF THE DEVICES BY NAME, DESCRIPTION TAG AND FREE UNIT
+#BUILT ONCE PER DEVICES DICTIONARY, KEPT UP TO DATE BY THE HELPERS BELOW AND REBUILT WHEN len(Devices) CHANGES
+class _DeviceIndex():
+
+    def __init__(self, Devices):
+        self.Devices = Devices
+        self.Rebuild()
+
+    def Rebuild(self):
+        self.Count = len(self.Devices)
+        self.Seen = {}          # unit: (Name, Description) as indexed
+        self.Names = {}         # Name: unit
+        self.Tags = {}          # tagName: {tag: unit}
+        self.FreeUnit = 1
+        for Unit in self.Devices:
+            self._Add(Unit)
+
+    def _Add(self, Unit):
+        Device = self.Devices[Unit]
+        self.Seen[Unit] = (Device.Name, Device.Description)
+        self.Names.setdefault(Device.Name, Unit)
+        for tagName, tag in _ParseDescriptionTags(Device.Description).items():
+            try:
+                self.Tags.setdefault(tagName, {}).setdefault(tag, Unit)
+            except TypeError:
+                pass            # unhashable tag values are not indexed
+
+    def _Remove(self, Unit):
+        Name, Description = self.Seen.pop(Unit)
+        if self.Names.get(Name) == Unit:
+            del self.Names[Name]
+        for tagName, tag in _ParseDescriptionTags(Description).items():
+            try:
+                if self.Tags.get(tagName, {}).get(tag) == Unit:
+                    del self.Tags[tagName][tag]
+            except TypeError:
+                pass
+
+    def Refresh(self, Unit):
+        # Re-index one device after it was created or updated
+        if len(self.Devices) != self.Count + (Unit in self.Devices and Unit not in self.Seen):
+            self.Rebuild()
+            return
+        if Unit in self.Seen:
+            self._Remove(Unit)
+        if Unit in self.Devices:
+            self.Count = len(self.Devices)
+            self._Add(Unit)
+
+    def Check(self):
+        # Devices added or removed outside the helpers
+        if len(self.Devices) != self.Count:
+            self.Rebuild()
+
+    def Revalidate(self):
+        # Devices renamed or edited outside the helpers (only string compares, no parsing)
+        self.Check()
+        for Unit, Device in self.Devices.items():
+            if self.Seen.get(Unit) != (Device.Name, Device.Description):
+                self.Refresh(Unit)
+
+    def FindName(self, Name, Prefix=False):
+        for Attempt in (0, 1):
+            if Attempt:
+                self.Revalidate()
+            else:
+                self.Check()
+            if Prefix:
+                for DeviceName, Unit in self.Names.items():
+                    if DeviceName.startswith(Name) and self.Devices[Unit].Name == DeviceName:
+                        return Unit
+            else:
+                Unit = self.Names.get(Name)
+                if Unit in self.Devices and self.Devices[Unit].Name == Name:
+                    return Unit
+        return False
+
+    def FindTag(self, tagName, tag):
+        for Attempt in (0, 1):
+            if Attempt:
+                self.Revalidate()
+            else:
+                self.Check()
+            Unit = self.Tags.get(tagName, {}).get(tag)
+            if Unit in self.Devices and self.Seen.get(Unit, (None, None))[1] == self.Devices[Unit].Description:
+                return Unit
+        return False
+
+    def NextFreeUnit(self, First=1):
+        self.Check()
+        if First > 1:
+            # Ranges other than the default one are scanned (they hold few devices)
+            Unit = First
+            while Unit in self.Devices:
+                Unit += 1
+            return Unit
+        while self.FreeUnit in self.Devices:
+            self.FreeUnit += 1
+        return self.FreeUnit
+
+_DeviceIndexes = {}
+
+def _GetDeviceIndex(Devices):
+    Index = _DeviceIndexes.get(id(Devices))
+    if Index is None or Index.Devices is not Devices:
+        Index = _DeviceIndexes[id(Devices)] = _DeviceIndex(Devices)
+    return Index
+
+def _RefreshDeviceIndex(Devices, Unit):
+    Index = _DeviceIndexes.get(id(Devices))
+    if Index is not None and Index.Devices is Devices:
+        Index.Refresh(Unit)
+
 #GET NEXT FREE DEVICE
-def GetNextFreeUnit(Devices):
-    # Find the next available unit, starting from 1
-    unit = 1
-    while unit in Devices:
-        unit += 1
+def GetNextFreeUnit(Devices, First=1):
+    # Find the next available unit, starting from First
+    unit = _GetDeviceIndex(Devices).NextFreeUnit(First)
     Domoticz.Debug('Next free device unit {}'.format(unit))
     return unit
+
+#CREATE A DEVICE (ON THE NEXT FREE UNIT IF NO UNIT IS GIVEN)
+def CreateDevice(Devices, Unit=None, **kwargs):
+    if Unit is None:
+        Unit = GetNextFreeUnit(Devices)
+    Domoticz.Device(Unit=Unit, **kwargs).Create()
+    _RefreshDeviceIndex(Devices, Unit)
+    return Unit
     
 #GET DEVICE UNIT BY NAME
 def FindUnitFromName(Devices, Parameters, Name, TruncSubName=False):
-    if TruncSubName:
-        for unit in [Unit for Unit in Devices if Devices[Unit].Name.startswith('{} - {}'.format(Parameters['Name'], Name))]:
-            return unit
-    else:
-        for unit in [Unit for Unit in Devices if Devices[Unit].Name == '{} - {}'.format(Parameters['Name'], Name)]:
-            return unit
-    return False
+    return _GetDeviceIndex(Devices).FindName('{} - {}'.format(Parameters['Name'], Name), Prefix=TruncSubName)
 
 #GET DEVICE UNIT BY USING THE DESCRIPTION FIELD
 def FindUnitFromDescription(Devices, Parameters, Name):
-    for unit in [Unit for Unit in Devices if GetTagFromDescription(Devices, Unit, 'Name') == '{} - {}'.format(Parameters['Name'], Name)]:
-        return unit
-    return False
+    return _GetDeviceIndex(Devices).FindTag('Name', '{} - {}'.format(Parameters['Name'], Name))
+
+#GET DEVICE UNIT BY A TAG IN THE DESCRIPTION FIELD
+def FindUnitFromTag(Devices, tagName, tag):
+    return _GetDeviceIndex(Devices).FindTag(tagName, tag)
 
 #ADD TAG TO DESCRIPTION OF A DEVICE
 def AddTagToDescription(Devices, Unit, tagName, tag):
-    descriptions = [] if Devices[Unit].Description == '' else [ Devices[Unit].Description ]
-    if 'Do not remove: ' in descriptions[0]:
-        descriptions = descriptions[0].split('; ')
-        for index, description in enumerate(descriptions):
-            if description.startswith('Do not remove: '):
-                Donotremove = json.loads(description[15:])
-                Donotremove[0][tagName] = tag
-                descriptions[index] = 'Do not remove: {}'.format(json.dumps(Donotremove))
-    else: 
-        descriptions += [ 'Do not remove: [{{"{}":"{}"}}]'.format(tagName, tag) ]
-    Devices[Unit].Update(Description='; '.join(descriptions), nValue=Devices[Unit].nValue, sValue=Devices[Unit].sValue)
+    AddTagsToDescription(Devices, Unit, {tagName: tag})
+
+#ADD SEVERAL TAGS TO DESCRIPTION OF A DEVICE (ONE UPDATE)
+def AddTagsToDescription(Devices, Unit, Tags):
+    Description = CreateDescription(Tags, Devices[Unit].Description)
+    if Description != Devices[Unit].Description:
+        Devices[Unit].Update(Description=Description, nValue=Devices[Unit].nValue, sValue=Devices[Unit].sValue)
+        _RefreshDeviceIndex(Devices, Unit)
+
+#CREATE (OR EXTEND) A DESCRIPTION WITH TAGS
+def CreateDescription(Tags, Description=''):
+    descriptions = [] if Description == '' else Description.split('; ')
+    for index, description in enumerate(descriptions):
+        if description.startswith('Do not remove: '):
+            descriptions[index] = 'Do not remove: {}'.format(json.dumps([{**_ParseDescriptionTags(description), **Tags}]))
+            break
+    else:
+        descriptions.append('Do not remove: {}'.format(json.dumps([Tags])))
+    return '; '.join(descriptions)
 
 #GET TAG FROM DESCRIPTION OF A DEVICE
 def GetTagFromDescription(Devices, Unit, tagName):
-    tag = None
-    descriptions = Devices[Unit].Description
-    if 'Do not remove: ' in descriptions:
-        descriptions = descriptions.split('; ')
-        for description in descriptions:
+    return _ParseDescriptionTags(Devices[Unit].Description).get(tagName)
+
+#GET ALL TAGS FROM DESCRIPTION OF A DEVICE
+def GetTagsFromDescription(Devices, Unit):
+    return dict(_ParseDescriptionTags(Devices[Unit].Description))
+
+#PARSE THE TAGS OF A DESCRIPTION (MEMOIZED BY THE RAW DESCRIPTION, DO NOT MODIFY THE RESULT)
+_DescriptionTags = {}
+_DESCRIPTION_TAGS_SIZE = 1024
+
+def _ParseDescriptionTags(Description):
+    tags = _DescriptionTags.get(Description)
+    if tags is not None:
+        return tags
+    tags = {}
+    if 'Do not remove: ' in Description:
+        for description in Description.split('; '):
             if description.startswith('Do not remove: '):
-                Donotremove = json.loads(description[15:])
-                if tagName in Donotremove[0]:
-                    tag = Donotremove[0][tagName]
-    return tag
+                try:
+                    tags.update(json.loads(description[15:])[0])
+                except (ValueError, IndexError, KeyError, TypeError):
+                    Domoticz.Debug('Invalid tags in description: {}'.format(description))
+    if len(_DescriptionTags) >= _DESCRIPTION_TAGS_SIZE:
+        _DescriptionTags.clear()
+    _DescriptionTags[Description] = tags
+    return tags
      
-#UPDATE THE DEVICE
+#UPDATE THE DEVICE (STAGED WHEN A DEVICE UPDATE BATCH IS ACTIVE IN THIS THREAD)
 def UpdateDevice(AlwaysUpdate, Devices, Unit, nValue, sValue, **kwargs):
-    Updated = False
-    if Unit in Devices:
-        kwargs = { key : value for key, value in kwargs.items() if value != getattr(Devices[Unit], key, None) }
-        default_kwargs = { 'TimedOut': 0 }
-        kwargs = { **default_kwargs, **kwargs }
-        if AlwaysUpdate or Devices[Unit].nValue != int(nValue) or Devices[Unit].sValue != str(sValue) or Devices[Unit].TimedOut != kwargs['TimedOut'] or len(kwargs)>1:
-            Domoticz.Debug('Update {}: nValue {} - sValue {} - Other: {}'.format(Devices[Unit].Name, nValue, sValue, kwargs))
-            Devices[Unit].Update(nValue=int(nValue), sValue=str(sValue), **kwargs)
-            Updated = True
-        else:
-            if not kwargs.get('TimedOut', 0):
-                Devices[Unit].Touch()
-    return Updated
+    Batch = _CurrentDeviceBatch(Devices)
+    if Batch is not None:
+        return Batch.Stage(AlwaysUpdate, Unit, nValue, sValue, **kwargs)
+    return _ApplyDeviceUpdate(AlwaysUpdate, Devices, Unit, nValue, sValue, kwargs) == 'Update'
+
+def _ApplyDeviceUpdate(AlwaysUpdate, Devices, Unit, nValue, sValue, kwargs):
+    # Returns the write done: 'Update', 'Touch' or None
+    if Unit not in Devices:
+        return None
+    # Defaults are merged before unchanged values are dropped: timing out a timed out device is no change
+    TimedOut = kwargs.get('TimedOut', 0)
+    kwargs = { key : value for key, value in { 'TimedOut': 0, **kwargs }.items() if value != getattr(Devices[Unit], key, None) }
+    if AlwaysUpdate or Devices[Unit].nValue != int(nValue) or Devices[Unit].sValue != str(sValue) or kwargs:
+        Domoticz.Debug('Update {}: nValue {} - sValue {} - Other: {}'.format(Devices[Unit].Name, nValue, sValue, kwargs))
+        # Update() resets TimedOut unless it is given
+        Devices[Unit].Update(nValue=int(nValue), sValue=str(sValue), **{ **kwargs, 'TimedOut': TimedOut })
+        if 'Name' in kwargs or 'Description' in kwargs:
+            _RefreshDeviceIndex(Devices, Unit)
+        return 'Update'
+    if not TimedOut:
+        Devices[Unit].Touch()
+        return 'Touch'
+    return None
+
+#BATCH OF DEVICE UPDATES: STAGE CHANGES AND WRITE ONLY THE NET CHANGE PER DEVICE ON FLUSH
+class DeviceUpdateBatch():
+
+    def __init__(self, Devices):
+        self.Devices = Devices
+        self.Staged = {}
+        self.Stats = { 'Staged': 0, 'Updates': 0, 'Touches': 0, 'Skipped': 0 }
+
+    def Stage(self, AlwaysUpdate, Unit, nValue=None, sValue=None, **kwargs):
+        # nValue/sValue None keeps the staged (or current) value; returns True if a write is pending
+        if Unit not in self.Devices:
+            return False
+        Staged = self.Staged.setdefault(Unit, { 'AlwaysUpdate': False, 'nValue': None, 'sValue': None, 'kwargs': {} })
+        Staged['AlwaysUpdate'] = Staged['AlwaysUpdate'] or AlwaysUpdate
+        if nValue is not None:
+            Staged['nValue'] = nValue
+        if sValue is not None:
+            Staged['sValue'] = sValue
+        Staged['kwargs'].update({ 'TimedOut': 0, **kwargs })
+        self.Stats['Staged'] += 1
+        return True
+
+    def Timeout(self, Unit):
+        self.Stage(False, Unit, TimedOut=TIMEDOUT)
+
+    def Flush(self):
+        for Unit, Staged in self.Staged.items():
+            if Unit not in self.Devices:
+                continue
+            Device = self.Devices[Unit]
+            Write = _ApplyDeviceUpdate(Staged['AlwaysUpdate'], self.Devices, Unit,
+                                       Device.nValue if Staged['nValue'] is None else Staged['nValue'],
+                                       Device.sValue if Staged['sValue'] is None else Staged['sValue'], Staged['kwargs'])
+            self.Stats['Updates' if Write == 'Update' else 'Touches' if Write == 'Touch' else 'Skipped'] += 1
+        self.Staged = {}
+        return dict(self.Stats)
+
+_DeviceBatches = threading.local()
+
+def _CurrentDeviceBatch(Devices):
+    Batch = getattr(_DeviceBatches, 'Batch', None)
+    return Batch if Batch is not None and Batch.Devices is Devices else None
+
+#START STAGING DEVICE UPDATES IN THIS THREAD (UpdateDevice AND TimeoutDevice ARE WRITTEN ON FlushDeviceUpdates)
+def StartDeviceUpdates(Devices):
+    if getattr(_DeviceBatches, 'Batch', None) is None:
+        _DeviceBatches.Batch = DeviceUpdateBatch(Devices)
+    return _DeviceBatches.Batch
+
+#WRITE THE STAGED DEVICE UPDATES OF THIS THREAD AND RETURN THE STATISTICS
+def FlushDeviceUpdates():
+    Batch = getattr(_DeviceBatches, 'Batch', None)
+    _DeviceBatches.Batch = None
+    return Batch.Flush() if Batch is not None else {}
 
 #GET sVALUE OF DEVICE
 def GetDevicesValue(Devices, Unit):
@@ -123,11 +335,11 @@ def UpdateDeviceBatSig(AlwaysUpdate, Devices, Unit, BatteryLevel=255, SignalLeve
 
 #SET DEVICE ON TIMED-OUT (OR ALL DEVICES)
 def TimeoutDevice(Devices, All=True, Unit=0):
-    if All:
-        for x in Devices:
-            UpdateDevice(False, Devices, x, Devices[x].nValue, Devices[x].sValue, TimedOut=TIMEDOUT)
-    else:
-        UpdateDevice(False, Devices, Unit, Devices[Unit].nValue, Devices[Unit].sValue, TimedOut=TIMEDOUT)
+    Batch = _CurrentDeviceBatch(Devices) or DeviceUpdateBatch(Devices)
+    for x in (Devices if All else [Unit]):
+        Batch.Timeout(x)
+    if Batch is not _CurrentDeviceBatch(Devices):
+        Batch.Flush()
 
 #SET DEVICES ON TIMED-OUT BY USING A TEXT IN THE DEVICE NAME
 def TimeoutDevicesByName(Devices, Name):
@@ -182,57 +394,317 @@ def setConfigItemDB(Key=None, Value=None):
         Domoticz.Error('Domoticz.Configuration operation failed: {}'.format(inst))
     return Config
     
+#CONFIGURATION FILE STORE (JSON FILE IN THE HOME FOLDER)
+#LOADED ONCE AND SERVED FROM MEMORY, RELOADED WHEN THE FILE IS CHANGED OUTSIDE THE STORE (MTIME/SIZE)
+#WRITES ARE MERGED DURING WriteDelay SECONDS (WRITE-BEHIND) AND WRITTEN ATOMICALLY (TEMP FILE + RENAME)
+class ConfigFileStore():
+
+    def __init__(self, FileName, WriteDelay=_CONFIG_WRITE_DELAY):
+        self.FileName = FileName
+        self.WriteDelay = WriteDelay
+        self.Lock = threading.RLock()
+        self.Data = {}
+        self.Stamp = False      # (mtime, size) of the file as last loaded or written, None if missing
+        self.Changed = set()    # keys set since the last write
+        self.Replaced = False   # whole configuration set since the last write
+        self.Timer = None
+        atexit.register(self.Flush)
+
+    def Get(self, Key=None, Default={}):
+        with self.Lock:
+            self._Load()
+            if Key is None:
+                return copy.deepcopy(self.Data)
+            return copy.deepcopy(self.Data.get(Key, Default))
+
+    def Set(self, Key=None, Value=None):
+        with self.Lock:
+            self._Load()
+            if Key is None:
+                self.Data = copy.deepcopy(dict(Value or {}))
+                self.Replaced = True
+            else:
+                self.Data[Key] = copy.deepcopy(Value)
+                self.Changed.add(Key)
+            if self.WriteDelay <= 0:
+                self.Flush()
+            elif self.Timer is None:
+                self.Timer = threading.Timer(self.WriteDelay, self.Flush)
+                self.Timer.daemon = True
+                self.Timer.start()
+            return copy.deepcopy(self.Data)
+
+    def Flush(self):
+        # Write the pending changes now (also called at exit, which Domoticz does not run when it stops a plugin)
+        with self.Lock:
+            Timer, self.Timer = self.Timer, None
+            if Timer is not None:
+                Timer.cancel()
+            self._Write()
+        # Joined outside the lock (a timer that already fired waits for it): no thread is left behind at stop
+        if Timer is not None and Timer is not threading.current_thread():
+            Timer.join()
+
+    def _Write(self):
+        # Called with the lock held
+        if not (self.Changed or self.Replaced):
+            return
+        self._Load()
+        Folder = os.path.dirname(self.FileName) or '.'
+        try:
+            Handle, TempName = tempfile.mkstemp(dir=Folder, prefix='.', suffix='.tmp')
+            try:
+                with os.fdopen(Handle, 'w') as outfile:
+                    json.dump(self.Data, outfile)
+                os.replace(TempName, self.FileName)
+            except BaseException:
+                os.remove(TempName)
+                raise
+            self.Stamp = self._FileStamp()
+            self.Changed, self.Replaced = set(), False
+        except Exception as inst:
+            Domoticz.Error('PluginParameter write file failed: {}.'.format(inst))
+
+    def _FileStamp(self):
+        try:
+            Stat = os.stat(self.FileName)
+            return (Stat.st_mtime_ns, Stat.st_size)
+        except FileNotFoundError:
+            return None
+
+    def _Load(self):
+        Stamp = self._FileStamp()
+        if Stamp == self.Stamp:
+            return
+        self.Stamp = Stamp
+        try:
+            Data = {}
+            if Stamp is not None:
+                with open(self.FileName) as infile:
+                    Data = json.load(infile)
+        except Exception as inst:
+            Domoticz.Error('PluginParameter read file failed: {}.'.format(inst))
+            return
+        # Changes that are not written yet win over the file
+        if not self.Replaced:
+            for Key in self.Changed:
+                Data[Key] = self.Data[Key]
+            self.Data = Data
+
+_ConfigFileStores = {}
+_ConfigFileStoresLock = threading.Lock()
+
+def _GetConfigFileStore(Parameters):
+    FileName = Parameters['HomeFolder']+_PLUGIN_PARAMETERS_FILE
+    with _ConfigFileStoresLock:
+        if FileName not in _ConfigFileStores:
+            _ConfigFileStores[FileName] = ConfigFileStore(FileName)
+        return _ConfigFileStores[FileName]
+
 #CONFIGURATION HELPER: GET ITEM FROM FILE
 def getConfigItemFile(Parameters, Key=None, Default={}):
-    value = Default
-    try:
-        with open(Parameters['HomeFolder']+_PLUGIN_PARAMETERS_FILE) as infile:
-            data = json.load(infile)
-        if (Key != None):
-            value = data[Key]    # only return requested key if there was one
-        else:
-            value = data         # return the whole configuration if no key
-    except KeyError:
-        value = Default
-    except Exception as inst:
-        Domoticz.Error('PluginParamter read file failed: {}.'.format(inst))
-    return value
+    return _GetConfigFileStore(Parameters).Get(Key, Default)
        
-#CONFIGURATION HELPER: SET ITEM TO FILE
+#CONFIGURATION HELPER: SET ITEM TO FILE (OTHER KEYS ARE KEPT)
+#WRITTEN AFTER A SHORT DELAY: CALL flushConfigItemFile IN onStop (DOMOTICZ DOES NOT RUN atexit WHEN IT STOPS A PLUGIN)
 def setConfigItemFile(Parameters, Key=None, Value=None):
-    data = {}
+    return _GetConfigFileStore(Parameters).Set(Key, Value)
+
+#CONFIGURATION HELPER: WRITE PENDING ITEMS TO FILE (E.G. IN onStop)
+def flushConfigItemFile(Parameters):
+    _GetConfigFileStore(Parameters).Flush()
+
+#WEBSOCKET FRAMES (https://tools.ietf.org/html/rfc6455)
+#ENCODER: ALL PAYLOAD LENGTHS (7, 16 AND 64 BITS), OPTIONAL MASKING AND FRAGMENTATION, CONTROL FRAMES
+#DECODER: INCREMENTAL PARSER OVER ONE bytearray, PAYLOADS ARE RETURNED AS memoryview (NO COPY PER FRAME)
+WS_CONTINUATION = 0x0
+WS_TEXT = 0x1
+WS_BINARY = 0x2
+WS_CLOSE = 0x8
+WS_PING = 0x9
+WS_PONG = 0xA
+_WS_CONTROL_MAX = 125      # maximum payload of a control frame
+_WS_MAX_MESSAGE = 16*1024*1024
+
+class WebSocketError(ValueError):
+    # Protocol violation; Code is the close status code to report to the peer
+    def __init__(self, Message, Code=1002):
+        super().__init__(Message)
+        self.Code = Code
+
+def _WebSocketMask(Data, Key):
+    # XOR with the repeated 4-byte key, done on integers instead of per byte
+    Length = len(Data)
+    if not Length:
+        return b''
+    Repeated = (bytes(Key) * (Length // 4 + 1))[:Length]
+    return (int.from_bytes(Data, 'little') ^ int.from_bytes(Repeated, 'little')).to_bytes(Length, 'little')
+
+def _WebSocketPayload(PayLoad):
+    return PayLoad.encode('utf-8') if isinstance(PayLoad, str) else PayLoad
+
+#CREATE ONE WEBSOCKET FRAME (Mask: None = UNMASKED (SERVER), True = RANDOM KEY (CLIENT) OR A 4-BYTE KEY)
+def FormatWebSocketFrame(PayLoad, Opcode=WS_TEXT, Fin=True, Mask=None):
+    PayLoad = _WebSocketPayload(PayLoad)
+    Length = len(PayLoad)
+    if Opcode >= WS_CLOSE and (Length > _WS_CONTROL_MAX or not Fin):
+        raise WebSocketError('Control frames carry at most {} bytes and cannot be fragmented'.format(_WS_CONTROL_MAX))
+    First = (0x80 if Fin else 0) | Opcode
+    MaskBit = 0x80 if Mask is not None else 0
+    if Length < 126:
+        Header = struct.pack('!BB', First, MaskBit | Length)
+    elif Length < 1 << 16:
+        Header = struct.pack('!BBH', First, MaskBit | 126, Length)
+    else:
+        Header = struct.pack('!BBQ', First, MaskBit | 127, Length)
+    if Mask is None:
+        return b''.join((Header, PayLoad))
+    Key = os.urandom(4) if Mask is True else bytes(Mask)
+    return b''.join((Header, Key, _WebSocketMask(PayLoad, Key)))
+
+#CREATE WEBSOCKET TEXT OR BINARY MESSAGE, SPLIT IN FRAMES OF FragmentSize BYTES IF GIVEN
+def FormatWebSocketMessage(PayLoad, Binary=False, Mask=None, FragmentSize=None):
+    PayLoad = memoryview(_WebSocketPayload(PayLoad)).cast('B')
+    Opcode = WS_BINARY if Binary else WS_TEXT
+    if not FragmentSize or len(PayLoad) <= FragmentSize:
+        return FormatWebSocketFrame(PayLoad, Opcode, True, Mask)
+    Frames = []
+    for Start in range(0, len(PayLoad), FragmentSize):
+        Frames.append(FormatWebSocketFrame(PayLoad[Start:Start+FragmentSize], Opcode if Start == 0 else WS_CONTINUATION,
+                                           Start + FragmentSize >= len(PayLoad), Mask))
+    return b''.join(Frames)
+
+#CREATE WEBSOCKET PING MESSAGE
+def FormatWebSocketPing(PayLoad='', Mask=None):
+    return FormatWebSocketFrame(PayLoad, WS_PING, True, Mask)
+
+#CREATE WEBSOCKET PONG MESSAGE (ECHOES THE PAYLOAD OF THE PING)
+def FormatWebSocketPong(PayLoad='', Mask=None):
+    return FormatWebSocketFrame(PayLoad, WS_PONG, True, Mask)
+
+#CREATE WEBSOCKET DISCONNECT MESSAGE (OPTIONAL STATUS CODE AND REASON)
+def FormatWebSocketMessageDisconnect(Code=None, Reason='', Mask=None):
+    PayLoad = struct.pack('!H', Code) + Reason.encode('utf-8') if Code is not None else b''
+    return FormatWebSocketFrame(PayLoad, WS_CLOSE, True, Mask)
+
+#GET STATUS CODE AND REASON FROM THE PAYLOAD OF A CLOSE FRAME
+#THE PAYLOAD COMES FROM THE PEER: AN INVALID ONE RAISES WebSocketError WITH THE STATUS CODE TO CLOSE WITH
+def ParseWebSocketClose(PayLoad):
+    if len(PayLoad) == 0:
+        return 1005, ''     # no status code present
+    if len(PayLoad) == 1:
+        raise WebSocketError('Close payload of 1 byte')
+    Code = struct.unpack_from('!H', PayLoad)[0]
+    # Codes below 1000, the codes that must not be sent (1004-1006, 1015) and unassigned protocol codes
+    if Code < 1000 or Code in (1004, 1005, 1006) or 1015 <= Code < 3000 or Code >= 5000:
+        raise WebSocketError('Invalid close status code {}'.format(Code))
     try:
-        if (Key != None):
-            data[Key] = Value
-        else:
-            data = Value         # set whole configuration if no key specified
-        with open(Parameters['HomeFolder']+_PLUGIN_PARAMETERS_FILE, 'w') as outfile:
-            json.dump(data, outfile)
-    except Exception as inst:
-        Domoticz.Error('PluginParamter read file failed: {}.'.format(inst))
-    return data
-
-#CREATE WEBSOCKET TEXT MESSAGE (https://tools.ietf.org/html/rfc6455)
-#CONDITIONS : ONLY TEXT FRAMES, ONE MESSAGE (FIN=1), NO MASKING, SMALLER THAN 127 BYTES PAYLOAD
-def FormatWebSocketMessage(PayLoad):
-    FormattedText = ''
-    if len(PayLoad) < 127:
-        FormattedText += '81'
-        FormattedText += '{:02X}'.format(len(PayLoad))
-    return bytes.fromhex(FormattedText) + bytes(PayLoad, 'utf-8')
-
-#CREATE WEBSOCKET PONG MESSAGE (https://tools.ietf.org/html/rfc6455)
-def FormatWebSocketPong(PayLoad):
-    FormattedText = ''
-    if len(PayLoad) < 127:
-        FormattedText += '8A'
-        FormattedText += '{:02X}'.format(len(PayLoad))
-    return bytes.fromhex(FormattedText) + bytes(PayLoad, 'utf-8')
-
-#CREATE WEBSOCKET DISCONNECT MESSAGE (https://tools.ietf.org/html/rfc6455)
-def FormatWebSocketMessageDisconnect():
-    FormattedText = '8800'
-    return bytes.fromhex(FormattedText)
+        return Code, str(PayLoad[2:], 'utf-8')
+    except UnicodeDecodeError:
+        raise WebSocketError('Close reason is not valid UTF-8', 1007)
+
+#INCREMENTAL WEBSOCKET PARSER: Feed() THE RECEIVED BYTES, THEN ITERATE Frames() OR Messages()
+#RequireMask: True FOR A SERVER (CLIENT FRAMES ARE MASKED), False FOR A CLIENT, None ACCEPTS BOTH
+class WebSocketParser():
+
+    def __init__(self, RequireMask=None, MaxMessageSize=_WS_MAX_MESSAGE):
+        self.RequireMask = RequireMask
+        self.MaxMessageSize = MaxMessageSize
+        self.Buffer = bytearray()
+        self.Offset = 0             # start of the first unparsed frame in Buffer
+        self.Fragments = []         # payloads of the message being reassembled
+        self.FragmentOpcode = None
+        self.FragmentSize = 0
+
+    def Feed(self, Data):
+        # Drop the parsed frames first; payload views handed out earlier keep the old buffer alive
+        if self.Offset:
+            try:
+                del self.Buffer[:self.Offset]
+            except BufferError:
+                self.Buffer = bytearray(memoryview(self.Buffer)[self.Offset:])
+            self.Offset = 0
+        self.Buffer += Data
+
+    def Frames(self):
+        # Complete frames as (Fin, Opcode, PayLoad memoryview); incomplete data stays buffered
+        Buffer = self.Buffer
+        while True:
+            Available = len(Buffer) - self.Offset
+            if Available < 2:
+                return
+            Position = self.Offset
+            First, Second = Buffer[Position], Buffer[Position+1]
+            Fin, Opcode, Masked, Length = bool(First & 0x80), First & 0x0F, bool(Second & 0x80), Second & 0x7F
+            Header = 2
+            if Length == 126:
+                if Available < 4:
+                    return
+                Length = struct.unpack_from('!H', Buffer, Position+2)[0]
+                Header = 4
+            elif Length == 127:
+                if Available < 10:
+                    return
+                Length = struct.unpack_from('!Q', Buffer, Position+2)[0]
+                Header = 10
+                if Length >> 63:
+                    raise WebSocketError('Invalid 64-bit payload length')
+            self._Check(First, Opcode, Fin, Masked, Length)
+            if Masked:
+                Header += 4
+            if Available < Header + Length:
+                return
+            Start = Position + Header
+            if Masked:
+                # Unmask in place: same length, so views handed out earlier stay valid
+                Buffer[Start:Start+Length] = _WebSocketMask(memoryview(Buffer)[Start:Start+Length], Buffer[Start-4:Start])
+            self.Offset = Start + Length
+            yield Fin, Opcode, memoryview(Buffer)[Start:Start+Length]
+
+    def Messages(self):
+        # Complete messages as (Opcode, PayLoad): str for text, memoryview otherwise (bytes when reassembled).
+        # Control frames are returned as they arrive, also in the middle of a fragmented message.
+        for Fin, Opcode, PayLoad in self.Frames():
+            if Opcode >= WS_CLOSE:
+                yield Opcode, PayLoad
+                continue
+            if Opcode != WS_CONTINUATION:
+                if self.FragmentOpcode is not None:
+                    raise WebSocketError('New message before the end of the fragmented message')
+                if Fin:
+                    yield Opcode, self._Decode(Opcode, PayLoad)
+                    continue
+                self.FragmentOpcode = Opcode
+            elif self.FragmentOpcode is None:
+                raise WebSocketError('Continuation frame without a message')
+            self.FragmentSize += len(PayLoad)
+            if self.FragmentSize > self.MaxMessageSize:
+                raise WebSocketError('Message larger than {} bytes'.format(self.MaxMessageSize), 1009)
+            self.Fragments.append(bytes(PayLoad))
+            if Fin:
+                Opcode, PayLoad = self.FragmentOpcode, b''.join(self.Fragments)
+                self.Fragments, self.FragmentOpcode, self.FragmentSize = [], None, 0
+                yield Opcode, self._Decode(Opcode, PayLoad)
+
+    def _Check(self, First, Opcode, Fin, Masked, Length):
+        if First & 0x70:
+            raise WebSocketError('Reserved bits set without a negotiated extension')
+        if Opcode not in (WS_CONTINUATION, WS_TEXT, WS_BINARY, WS_CLOSE, WS_PING, WS_PONG):
+            raise WebSocketError('Unknown opcode {}'.format(Opcode))
+        if Opcode >= WS_CLOSE and (Length > _WS_CONTROL_MAX or not Fin):
+            raise WebSocketError('Invalid control frame')
+        if self.RequireMask is not None and Masked != self.RequireMask:
+            raise WebSocketError('Frame must {}be masked'.format('' if self.RequireMask else 'not '))
+        if Length > self.MaxMessageSize:
+            raise WebSocketError('Frame larger than {} bytes'.format(self.MaxMessageSize), 1009)
+
+    def _Decode(self, Opcode, PayLoad):
+        if Opcode != WS_TEXT:
+            return PayLoad
+        try:
+            return str(PayLoad, 'utf-8')
+        except UnicodeDecodeError:
+            raise WebSocketError('Text message is not valid UTF-8', 1007)
 
 #GET CPU TEMPERATURE
 def getCPUtemperature():
@@ -244,8 +716,14 @@ def getCPUtemperature():
     
 #CALCULATE DISTANCE BASED ON GPS COORDINATES
 from math import radians, sin, cos, atan2, sqrt
+from itertools import chain
+numpy = None                # imported on the first large batch: importing it takes longer than starting the plugin
+_NumpyImported = False
+_EARTH_RADIUS = 6371        # km
+_NUMPY_MIN_POINTS = 32      # below this many distances the pure Python loop is faster
+
 def getDistance(origin, destination, unit='km'):
-    radius = 6371 # km
+    radius = _EARTH_RADIUS
 
     dlat = radians(destination[0]-origin[0])
     dlon = radians(destination[1]-origin[1])
@@ -256,4 +734,54 @@ def getDistance(origin, destination, unit='km'):
 
     return d*1000 if unit=='m' else d 
 
+#CALCULATE DISTANCES FROM ONE ORIGIN TO A LIST OF DESTINATIONS (SAME FORMULA AS getDistance)
+def getDistances(origin, destinations, unit='km'):
+    if len(destinations) >= _NUMPY_MIN_POINTS and _getNumpy() is not None:
+        return _getDistancesNumpy(_coordinateArray([origin]), _coordinateArray(destinations), unit)[0].tolist()
+
+    # Terms that only depend on the origin are computed once
+    cosOrigin = cos(radians(origin[0]))
+    distances = []
+    for destination in destinations:
+        dlat = radians(destination[0]-origin[0])
+        dlon = radians(destination[1]-origin[1])
+        a = sin(dlat/2) * sin(dlat/2) + cosOrigin \
+            * cos(radians(destination[0])) * sin(dlon/2) * sin(dlon/2)
+        d = _EARTH_RADIUS * (2 * atan2(sqrt(a), sqrt(1-a)))
+        distances.append(d*1000 if unit=='m' else d)
+    return distances
+
+#CALCULATE THE DISTANCE OF ALL PAIRS: ONE ROW PER ORIGIN (DESTINATIONS DEFAULT TO THE ORIGINS)
+def getDistanceMatrix(origins, destinations=None, unit='km'):
+    destinations = origins if destinations is None else destinations
+    if len(origins) * len(destinations) >= _NUMPY_MIN_POINTS and _getNumpy() is not None:
+        return _getDistancesNumpy(_coordinateArray(origins), _coordinateArray(destinations), unit).tolist()
+    return [ getDistances(origin, destinations, unit) for origin in origins ]
+
+def _getNumpy():
+    # None when NumPy is not installed: batch distances fall back to pure Python
+    global numpy, _NumpyImported
+    if not _NumpyImported:
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+        _NumpyImported = True
+    return numpy
+
+def _coordinateArray(points):
+    # (lat, lon, ...) points as an N x 2 float array; fromiter is much faster than asarray on a list of tuples
+    if isinstance(points, numpy.ndarray):
+        return points.astype(float, copy=False).reshape(len(points), -1)[:, :2]
+    return numpy.fromiter(chain.from_iterable(points), dtype=float).reshape(len(points), -1)[:, :2]
 
+def _getDistancesNumpy(origins, destinations, unit):
+    # Broadcast origins (rows) against destinations (columns)
+    originLat, originLon = origins[:, 0:1], origins[:, 1:2]
+    destinationLat, destinationLon = destinations[:, 0], destinations[:, 1]
+    dlat = numpy.radians(destinationLat - originLat)
+    dlon = numpy.radians(destinationLon - originLon)
+    sinDlat, sinDlon = numpy.sin(dlat/2), numpy.sin(dlon/2)
+    a = sinDlat * sinDlat + numpy.cos(numpy.radians(originLat)) * numpy.cos(numpy.radians(destinationLat)) * sinDlon * sinDlon
+    d = _EARTH_RADIUS * (2 * numpy.arctan2(numpy.sqrt(a), numpy.sqrt(1-a)))
+    return d*1000 if unit=='m' else d
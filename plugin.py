@@ -10,8 +10,15 @@
 """
 <plugin key="Telenet" name="Telenet" author="Filip Demaertelaere" version="3.0.0">
     <params>
-        <param field="Mode1" label="Username" width="200px" required="true" default=""/>
-        <param field="Mode2" label="Password" width="200px" required="true" default="" password="true"/>
+        <param field="Mode1" label="Username(s), separated by ;" width="300px" required="true" default=""/>
+        <param field="Mode2" label="Password(s), separated by ;" width="300px" required="true" default="" password="true"/>
+        <param field="Mode3" label="Shared cache folder (optional)" width="300px" required="false" default=""/>
+        <param field="Mode4" label="Metrics devices" width="120px">
+            <options>
+                <option label="True" value="True"/>
+                <option label="False" value="False" default="True"/>
+            </options>
+        </param>
         <param field="Mode5" label="Hours between update" width="120px" required="true" default="1"/>
         <param field="Mode6" label="Debug" width="120px">
             <options>
@@ -31,16 +38,276 @@ sys.path.append('/usr/local/lib/python{}.{}/dist-packages'.format(major, minor))
 sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
 from domoticz_tools import *
 import Domoticz
-import Telenet
+import telemeter_store
 import threading
 import queue
+import datetime
+import heapq
+import json
+import random
+import traceback
 import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+#TELENET (AND REQUESTS) IS IMPORTED BY THE WORKER THREAD, SEE loadTelenet()
+Telenet = None
 
 #DEFAULT IMAGE
 _IMAGE = 'Telenet'
 
-#THE HAERTBEAT IS EVERY 10s
-_HOUR = MINUTE*60
+#POLLING SCHEDULE (SECONDS)
+_HOUR = 3600
+_FIRST_POLL = 60             # first poll after start
+_BACKOFF_BASE = 60           # first retry delay after a failure
+_REFRESH_MARGIN = 300        # poll this long after Telenet is expected to refresh its counters
+_REFRESH_SAMPLES = 3         # observed refreshes needed before aligning polls
+_ERROR_THRESHOLD = 3         # failures before devices are timed out
+_MAX_STRETCH = 4             # aligned polls wait at most this many intervals
+
+#WORKER SUPERVISION
+_WORKER_RESTARTS = 5         # restarts of the worker thread allowed...
+_WORKER_RESTART_WINDOW = 3600  # ...within this many seconds
+_STOP_TIMEOUT = 5            # seconds onStop waits for the worker thread
+_TRACEBACK_FILE = 'Telenet_traceback.txt'
+_TRACEBACK_MAX_BYTES = 256*1024
+_TRACEBACK_BACKUPS = 2
+
+#INSTRUMENTATION
+_METRICS_FILE = 'Telenet_metrics.json'
+_METRICS_DEVICES = { 'Poll duration': ('seconds', lambda Metrics: Metrics['current_cycle'].get('seconds', 0)),
+                     'Requests per poll': ('requests', lambda Metrics: Metrics['current_cycle'].get('requests', 0)),
+                     'Queue wait': ('seconds', lambda Metrics: Metrics['queue']['last_wait']) }
+
+#ACCOUNTS
+_ACCOUNT_SEPARATOR = ';'
+_UNITS_PER_ACCOUNT = 50      # device units reserved per account (Domoticz allows 255 units)
+_MAX_ACCOUNTS = 5
+_ACCOUNT_WORKERS = 4         # accounts polled in parallel
+
+#CONFIGURATION KEY FOR THE PERSISTED TELENET SESSIONS (PER USERNAME)
+_SESSION = 'Session'
+
+#CONFIGURATION KEY FOR THE CACHED BILLING CYCLES
+_BILLING_CYCLES = 'BillingCycles'
+
+################################################################################
+# Poll scheduler
+################################################################################
+
+class PollScheduler:
+
+    def __init__(self, interval, clock=time.time):
+        self.interval = interval
+        self.clock = clock
+        self.next_due = clock() + _FIRST_POLL
+        self.failures = 0
+        self.unchanged = 0
+        self.last_poll = None
+        self.refresh_times = deque(maxlen=10)   # seconds after midnight at which values changed
+
+    def due(self):
+        return self.clock() >= self.next_due
+
+    def dispatched(self):
+        # Do not fire again while the poll is running; success() or failure() reschedules
+        self.next_due = self.clock() + self.interval
+
+    def success(self, changed):
+        now = self.clock()
+        self.failures = 0
+        if changed:
+            self.unchanged = 0
+            # Telenet refreshed somewhere between the previous and this poll (only precise enough
+            # when both polls were at most one interval apart)
+            if self.last_poll is not None and now - self.last_poll <= self.interval:
+                self.refresh_times.append(self._time_of_day((now + self.last_poll) / 2))
+        else:
+            self.unchanged += 1
+        self.last_poll = now
+        self.next_due = now + self.interval
+        expected = self._next_refresh()
+        if expected is not None and self.unchanged:
+            # Alignment only delays a poll: once polls at the configured interval have shown unchanged
+            # values, wait until just after the next expected refresh instead of polling before it
+            aligned = expected + _REFRESH_MARGIN
+            if aligned > self.next_due:
+                self.next_due = min(aligned, now + self.interval*_MAX_STRETCH)
+
+    def failure(self):
+        # Exponential backoff with equal jitter, capped by the configured interval
+        self.failures += 1
+        delay = min(self.interval, _BACKOFF_BASE * 2**(self.failures-1))
+        self.next_due = self.clock() + delay/2 + random.random()*delay/2
+
+    def _next_refresh(self):
+        # First expected refresh after the last poll (earlier refreshes are already in its values)
+        if len(self.refresh_times) < _REFRESH_SAMPLES:
+            return None
+        midnight = self.last_poll - self._time_of_day(self.last_poll)
+        candidates = [ midnight + t + day*_HOUR*24 for t in self.refresh_times for day in (0, 1) ]
+        return min([ c for c in candidates if c > self.last_poll ])
+
+    @staticmethod
+    def _time_of_day(timestamp):
+        t = time.localtime(timestamp)
+        return t.tm_hour*_HOUR + t.tm_min*60 + t.tm_sec
+
+################################################################################
+# Task queue
+################################################################################
+
+class TaskQueue:
+    # Priority queue for the worker thread: shutdown (None) first, then Login, then data tasks.
+    # Identical pending actions are coalesced and tasks past their 'Deadline' are dropped.
+    PRIORITIES = { 'Login': 1 }
+    DEFAULT_PRIORITY = 2
+
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self.heap = []
+        self.pending = set()
+        self.counter = 0
+        self.condition = threading.Condition()
+        self.unfinished = 0
+        self.enqueued = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.last_wait = 0.0
+        self.max_wait = 0.0
+        self.total_wait = 0.0
+        self.handled = 0
+
+    def put(self, task):
+        with self.condition:
+            if task is None:
+                priority, action = 0, None
+            else:
+                action = task['Action']
+                if action in self.pending:
+                    self.coalesced += 1
+                    return False
+                priority = self.PRIORITIES.get(action, self.DEFAULT_PRIORITY)
+                self.pending.add(action)
+            heapq.heappush(self.heap, (priority, self.counter, time.monotonic(), task))
+            self.counter += 1
+            self.enqueued += 1
+            self.unfinished += 1
+            self.condition.notify()
+            return True
+
+    def get(self, block=True, timeout=None):
+        with self.condition:
+            while True:
+                if not self.heap:
+                    if not block or not self.condition.wait(timeout):
+                        raise queue.Empty
+                    continue
+                priority, counter, queued, task = heapq.heappop(self.heap)
+                if task is not None:
+                    self.pending.discard(task['Action'])
+                    if task.get('Deadline') is not None and self.clock() > task['Deadline']:
+                        self.dropped += 1
+                        self.unfinished -= 1
+                        self.condition.notify_all()
+                        continue
+                self.last_wait = time.monotonic() - queued
+                self.max_wait = max(self.max_wait, self.last_wait)
+                self.total_wait += self.last_wait
+                self.handled += 1
+                return task
+
+    def task_done(self):
+        with self.condition:
+            self.unfinished -= 1
+            self.condition.notify_all()
+
+    def join(self, timeout=None):
+        # Wait until all queued tasks are handled
+        with self.condition:
+            return self.condition.wait_for(lambda: self.unfinished <= 0, timeout)
+
+    def qsize(self):
+        with self.condition:
+            return len(self.heap)
+
+    def stats(self):
+        with self.condition:
+            return { 'depth': len(self.heap), 'enqueued': self.enqueued, 'coalesced': self.coalesced, 'dropped': self.dropped,
+                     'last_wait': self.last_wait, 'max_wait': self.max_wait,
+                     'avg_wait': self.total_wait/self.handled if self.handled else 0.0 }
+
+################################################################################
+# Worker lifecycle
+################################################################################
+
+class WorkerLifecycle:
+    # Start, supervision and shutdown of the worker thread. stop() sets the stop event, aborts the
+    # blocking I/O (closing the HTTP sessions), wakes the worker and joins it with a bounded wait.
+
+    def __init__(self, target, name='QueueThread', clock=time.time):
+        self.target = target
+        self.name = name
+        self.clock = clock
+        self.stopping = threading.Event()
+        self.thread = None
+        self.restarts = deque()
+        self.stop_latency = None
+
+    def start(self):
+        self.thread = threading.Thread(name=self.name, target=self.target, daemon=True)
+        self.thread.start()
+
+    def supervise(self):
+        # Restart the worker thread when it died, within the restart budget
+        if self.stopping.is_set() or self.thread is None or self.thread.is_alive():
+            return
+        now = self.clock()
+        while self.restarts and self.restarts[0] < now - _WORKER_RESTART_WINDOW:
+            self.restarts.popleft()
+        if len(self.restarts) < _WORKER_RESTARTS:
+            self.restarts.append(now)
+            Domoticz.Error('Task handler stopped unexpectedly, restarting ({}/{}).'.format(len(self.restarts), _WORKER_RESTARTS))
+            self.start()
+        elif len(self.restarts) == _WORKER_RESTARTS:
+            self.restarts.append(now)
+            Domoticz.Error('Task handler keeps failing; restart budget exhausted, see {}.'.format(_TRACEBACK_FILE))
+
+    def stop(self, aborts=(), wake=None, timeout=_STOP_TIMEOUT):
+        # True when the worker has exited within the timeout; stop_latency holds the time taken
+        start = time.perf_counter()
+        self.stopping.set()
+        for abort in aborts:
+            abort()
+        if wake:
+            wake()
+        if self.thread is not None:
+            self.thread.join(timeout)
+        self.stop_latency = time.perf_counter() - start
+        return self.thread is None or not self.thread.is_alive()
+
+################################################################################
+# Telenet account
+################################################################################
+
+class TelenetAccount:
+
+    def __init__(self, index, username, password, adapter, cache=None):
+        self.index = index
+        self.client = Telenet.Telenet(username, password, adapter=adapter, cache=cache)
+        self.login_count = 0
+        self.first_unit = index*_UNITS_PER_ACCOUNT + 1
+        self.received = False               # data received since the start
+        self.failures = 0                   # consecutive failed polls of this account
+        self.received_contracts = set()
+        self.contract_failures = {}         # consecutive failed polls per contract
+
+    def device_name(self, name):
+        # The first account keeps the plain names (and units) of single-account installations
+        return name if self.index == 0 else '{} ({})'.format(name, self.client.username)
+
+    def next_free_unit(self):
+        return GetNextFreeUnit(Devices, First=self.first_unit)
 
 ################################################################################
 # Start Plugin
@@ -50,12 +317,18 @@ class BasePlugin:
 
     def __init__(self):
         self.debug = DEBUG_OFF
-        self.runAgain = MINUTE
-        self.Login = False
-        self.ErrorLevel = 0
-        self.MyTelenet = None
-        self.tasksQueue = queue.Queue()
-        self.tasksThread = threading.Thread(name='QueueThread', target=BasePlugin.handleTasks, args=(self,))
+        self.clock = time.time
+        self.Scheduler = None
+        self.Received = False
+        self.Store = None
+        self.Adapter = None
+        self.Accounts = []
+        self.Sessions = {}
+        self.BillingCycles = {}
+        self.tasksQueue = TaskQueue()
+        self.Lifecycle = WorkerLifecycle(self.handleTasks)
+        self.TracebackLogger = None
+        self.TracebackListener = None
 
     def onStart(self):
         Domoticz.Debug('onStart called')
@@ -70,31 +343,31 @@ class BasePlugin:
         if _IMAGE not in Images:
             Domoticz.Image('Telenet.zip').Create()
 
-        # Timeout all devices
-        TimeoutDevice(Devices, All=True)
-        
-        # Start thread
-        self.MyTelenet = Telenet.Telenet(Parameters['Mode1'], Parameters['Mode2'])
-        self.tasksThread.start()
+        # Devices are only timed out when the first poll fails (see pollFailed)
+
+        # Schedule polling
+        self.Scheduler = PollScheduler(_HOUR*float(Parameters['Mode5'].replace(',','.')), clock=self.clock)
+        self.tasksQueue.clock = self.clock
+        self.Lifecycle.clock = self.clock
+
+        # Local history of the readings
+        self.Store = telemeter_store.TelemeterStore(Parameters['HomeFolder'])
+
+        # Start thread (the traceback log and the Telenet clients are set up on the worker thread)
+        self.Lifecycle.start()
         self.tasksQueue.put({'Action': 'Login'})
 
     def onStop(self):
         Domoticz.Debug('onStop called')
         
-        # Signal queue thread to exit
-        self.tasksQueue.put(None)
-        self.tasksThread.join()
-
-        # Wait until queue thread has exited
-        Domoticz.Debug('Threads still active: {} (should be 1)'.format(threading.active_count()))
-        endTime = time.time() + 70
-        while (threading.active_count() > 1) and (time.time() < endTime):
-            for thread in threading.enumerate():
-                if thread.name != threading.current_thread().name:
-                    Domoticz.Debug('Thread {} is still running, waiting otherwise Domoticz will abort on plugin exit.'.format(thread.name))
-            time.sleep(1.0)
-
-        Domoticz.Debug('Plugin stopped')
+        # Abort running Telenet requests (of all accounts) and signal queue thread to exit
+        Stopped = self.Lifecycle.stop(aborts=[ Account.client.cancel for Account in self.Accounts ], wake=lambda: self.tasksQueue.put(None))
+        if self.TracebackListener:
+            self.TracebackListener.stop()
+        if Stopped:
+            Domoticz.Debug('Plugin stopped in {:.1f} ms'.format(self.Lifecycle.stop_latency*1000))
+        else:
+            Domoticz.Error('Task handler did not stop within {}s, threads still active: {}.'.format(_STOP_TIMEOUT, ', '.join(thread.name for thread in threading.enumerate() if thread is not threading.current_thread())))
 
     def onConnect(self, Connection, Status, Description):
         Domoticz.Debug('onConnect called ({}) with status={}'.format(Connection.Name, Status))
@@ -114,78 +387,317 @@ class BasePlugin:
         Domoticz.Debug('onDisconnect called ({})'.format(Connection.Name))
 
     def onHeartbeat(self):
-        self.runAgain -= 1
-        if self.runAgain <= 0:
-
-            self.tasksQueue.put({'Action': 'GetInternetVolume'})
-            if self.ErrorLevel == 3:
-                TimeoutDevice(Devices, All=True)
-                Domoticz.Error('Unable to get data from Telenet.')
-            if self.ErrorLevel and not self.ErrorLevel % 2:
-                self.tasksQueue.put({'Action': 'Login'})
-                
-            self.runAgain = _HOUR*float(Parameters['Mode5'].replace(',','.'))
+        self.Lifecycle.supervise()
+        if self.Scheduler.due():
+            self.Scheduler.dispatched()
+            self.tasksQueue.put({'Action': 'GetInternetVolume', 'Deadline': self.Scheduler.next_due})
+
+    def startAccounts(self):
+        # All accounts share one connection pool; every client keeps its own cookie jar
+        loadTelenet()
+        Usernames = [ Username.strip() for Username in Parameters['Mode1'].split(_ACCOUNT_SEPARATOR) ]
+        # A single account keeps its password as entered (it may contain the separator or spaces)
+        Passwords = Parameters['Mode2'].split(_ACCOUNT_SEPARATOR) if len(Usernames) > 1 else [ Parameters['Mode2'] ]
+        if len(Usernames) != len(Passwords):
+            Domoticz.Error('Number of usernames ({}) and passwords ({}) differ, only the first {} account(s) are used.'.format(len(Usernames), len(Passwords), min(len(Usernames), len(Passwords))))
+        Credentials = list(zip(Usernames, Passwords))
+        if len(Credentials) > _MAX_ACCOUNTS:
+            Domoticz.Error('At most {} accounts are supported, only the first {} are used.'.format(_MAX_ACCOUNTS, _MAX_ACCOUNTS))
+            del Credentials[_MAX_ACCOUNTS:]
+        self.Adapter = Telenet.create_adapter(len(Credentials))
+        # GET responses can be shared with other Domoticz instances and scripts polling the same accounts
+        Cache = None
+        if Parameters['Mode3'].strip():
+            try:
+                Cache = Telenet.TelenetResponseCache(Parameters['Mode3'].strip())
+            except OSError as err:
+                Domoticz.Error('Shared cache folder cannot be used, polling without it: {}'.format(err))
+        self.Accounts = [ TelenetAccount(Index, Username, Password, self.Adapter, Cache) for Index, (Username, Password) in enumerate(Credentials) ]
+
+        # Sessions of a previous run (a single session of older versions belongs to the first account)
+        self.Sessions = getConfigItemDB(_SESSION, {})
+        if not isinstance(self.Sessions, dict):
+            self.Sessions = { self.Accounts[0].client.username: self.Sessions }
+        # Billing cycles are keyed by contract, so all clients share one dictionary
+        self.BillingCycles = dict(getConfigItemDB(_BILLING_CYCLES, {}))
+        for Account in self.Accounts:
+            Account.client.billing_cycles = self.BillingCycles
+            if Account.client.import_session(self.Sessions.get(Account.client.username, '')):
+                Domoticz.Debug('Restored Telenet session of {} from previous run.'.format(Account.client.username))
+
+    def startTracebackLog(self):
+        # Tracebacks are written by a listener thread to a size-capped, rotated file
+        import logging, logging.handlers
+        handler = logging.handlers.RotatingFileHandler('{}{}'.format(Parameters['HomeFolder'], _TRACEBACK_FILE), maxBytes=_TRACEBACK_MAX_BYTES, backupCount=_TRACEBACK_BACKUPS, delay=True)
+        handler.setFormatter(logging.Formatter('%(asctime)s %(threadName)s\n%(message)s---------------------------------'))
+        logQueue = queue.SimpleQueue()
+        self.TracebackListener = logging.handlers.QueueListener(logQueue, handler)
+        self.TracebackLogger = logging.getLogger('Telenet.traceback')
+        self.TracebackLogger.propagate = False
+        self.TracebackLogger.handlers = [ logging.handlers.QueueHandler(logQueue) ]
+        self.TracebackListener.start()
+
+    def logTraceback(self):
+        Domoticz.Debug('TaskHandler TRACEBACK: {}'.format(traceback.format_exc()))
+        if self.TracebackLogger:
+            self.TracebackLogger.error(traceback.format_exc())
 
     # Thread to handle the messages
     def handleTasks(self):
-        try:
-            Domoticz.Debug('Entering tasks handler')
-            while True:
-                task = self.tasksQueue.get(block=True)
-                if task is None:
-                    Domoticz.Debug('Exiting task handler')
-                    try:
-                        self.MyTelenet.close()
-                    except AttributeError:
-                        pass
-                    self.tasksQueue.task_done()
-                    break
-
-                Domoticz.Debug('Handling task: {}.'.format(task['Action']))
-                if task['Action'] == 'Login':
-                    self.Login = False
-                    if self.MyTelenet.login() and self.MyTelenet.get_user_data():
-                        self.Login = True
-                    else:
-                        self.ErrorLevel += 1
-                        Domoticz.Error('Unable to login on MyTelenet with defined hardware settings or no contract data found.')
-                        
-                elif task['Action'] == 'GetInternetVolume':
-                    if self.Login and self.MyTelenet.login() and self.MyTelenet.get_user_data():
-                        if self.MyTelenet.telemeter():
-                            for Contract in self.MyTelenet.telemeter_info:
-                                Unit = FindUnitFromName(Devices, Parameters, Contract['municipality'])
-                                if not Unit:
-                                    Unit = GetNextFreeUnit(Devices)
-                                    description = CreateDescription(Contract['businessidentifier'])
-                                    Domoticz.Device(Unit=Unit, Name=Contract['municipality'], Description=description, TypeName="Custom", Options={"Custom": "0;GB"}, Image=Images[_IMAGE].ID, Used=1).Create()
-                                    TimeoutDevice(Devices, Unit=Unit)
-                                if 'total_usage_gb' in Contract:
-                                    UpdateDevice(False, Devices, Unit, 0, '%.3f' % Contract['total_usage_gb'])
-                                    Domoticz.Debug('Telenet Usage: {}'.format(Contract['total_usage_gb']))
-                                    self.ErrorLevel = 0
-                            else:
-                                self.ErrorLevel += 1
-                        else:
-                            self.ErrorLevel += 1
-                    else:
-                        self.ErrorLevel += 1
-
-                else:
-                    Domoticz.Error('TaskHandler: unknown action code {}'.format(task['Action']))
-
+        Domoticz.Debug('Entering tasks handler')
+        if self.TracebackListener is None:
+            self.startTracebackLog()
+        if not self.Accounts:
+            try:
+                self.startAccounts()
+            except Exception as err:
+                Domoticz.Error('Unable to start the Telenet clients: {}'.format(err))
+                self.logTraceback()
+                raise
+        while True:
+            task = self.tasksQueue.get(block=True)
+            if task is None:
+                Domoticz.Debug('Exiting task handler')
+                try:
+                    for Account in self.Accounts:
+                        if Account.client.authenticated:
+                            self.Sessions[Account.client.username] = Account.client.export_session()
+                        Account.client.close()
+                    if self.Accounts:
+                        setConfigItemDB(_SESSION, self.Sessions)
+                        self.Adapter.close()
+                except AttributeError:
+                    pass
+                self.tasksQueue.task_done()
+                break
+
+            # Failures are contained per task so that the worker keeps polling
+            Domoticz.Debug('Handling task: {} (queued {:.3f}s, depth {}).'.format(task['Action'], self.tasksQueue.last_wait, self.tasksQueue.qsize()))
+            try:
+                StartDeviceUpdates(Devices)
+                try:
+                    self.handleTask(task)
+                except Exception as err:
+                    Domoticz.Error('General error TaskHandler ({}): {}'.format(task['Action'], err))
+                    self.logTraceback()
+                    if task['Action'] == 'GetInternetVolume':
+                        self.pollFailed()
+                # Metrics are not part of the poll: failing to write them must not back off or time out devices
+                try:
+                    self.writeMetrics(task)
+                except Exception as err:
+                    Domoticz.Error('Writing metrics failed ({}): {}'.format(task['Action'], err))
+                    self.logTraceback()
+                # Write the net device changes of this task at once
+                try:
+                    Domoticz.Debug('Device updates: {}'.format(FlushDeviceUpdates()))
+                except Exception as err:
+                    Domoticz.Error('Writing device updates failed ({}): {}'.format(task['Action'], err))
+                    self.logTraceback()
                 Domoticz.Debug('Finished handling task: {}.'.format(task['Action']))
+            finally:
+                # TaskQueue.join() must return even when the worker dies on this task
                 self.tasksQueue.task_done()
 
+    def handleTask(self, task):
+        if task['Action'] == 'Login':
+            for Account, LoggedIn in zip(self.Accounts, self.forAccounts(self.loginAccount)):
+                if not LoggedIn and not self.Lifecycle.stopping.is_set():
+                    Domoticz.Error('Unable to login on MyTelenet as {} or no contract data found.'.format(Account.client.username))
+                
+        elif task['Action'] == 'GetInternetVolume':
+            # The accounts are polled in parallel, the devices are updated on this thread
+            BillingCycles = dict(self.BillingCycles)
+            Polls = self.forAccounts(self.pollAccount)
+            if self.Lifecycle.stopping.is_set():
+                # Requests aborted by onStop are no reason to time out the devices
+                return
+            if self.BillingCycles != BillingCycles:
+                setConfigItemDB(_BILLING_CYCLES, self.BillingCycles)
+            Received, Changed = False, False
+            for Account, Contracts in zip(self.Accounts, Polls):
+                if Contracts is not None and any(Contract.usage_ok for Contract in Account.client.telemeter_info):
+                    Received = True
+                    Account.received, Account.failures = True, 0
+                    Changed = self.updateAccountDevices(Account, Contracts) or Changed
+                else:
+                    Domoticz.Debug('Unable to get data from Telenet for {}.'.format(Account.client.username))
+                    self.accountFailed(Account)
+            if Received:
+                self.Received = True
+                self.Scheduler.success(Changed)
+            else:
+                self.pollFailed()
+
+        else:
+            Domoticz.Error('TaskHandler: unknown action code {}'.format(task['Action']))
+
+        # Persist the sessions after each new login
+        if any(Account.client.login_count != Account.login_count for Account in self.Accounts):
+            for Account in self.Accounts:
+                Account.login_count = Account.client.login_count
+                self.Sessions[Account.client.username] = Account.client.export_session()
+            setConfigItemDB(_SESSION, self.Sessions)
+
+    def forAccounts(self, Function):
+        # Run Function for every account on a bounded pool (no extra thread for a single account)
+        if len(self.Accounts) == 1:
+            return [ Function(self.Accounts[0]) ]
+        with ThreadPoolExecutor(max_workers=min(len(self.Accounts), _ACCOUNT_WORKERS), thread_name_prefix='TelenetAccount') as executor:
+            return list(executor.map(Function, self.Accounts))
+
+    def loginAccount(self, Account):
+        Account.client.start_cycle()
+        try:
+            return Account.client.login() and Account.client.get_user_data()
+        except Telenet.TelenetCancelled:
+            return False
         except Exception as err:
-            Domoticz.Error('General error TaskHandler: {}'.format(err))
-            # For debugging
-            import traceback
-            Domoticz.Debug('Login error TRACEBACK: {}'.format(traceback.format_exc()))
-            with open('{}Telenet_traceback.txt'.format(Parameters['HomeFolder']), "a") as myfile:
-                myfile.write('{}'.format(traceback.format_exc()))
-                myfile.write('---------------------------------\n')
-            self.tasksQueue.task_done()
+            Domoticz.Error('Login of {} failed: {}'.format(Account.client.username, err))
+            self.logTraceback()
+            return False
+
+    def pollAccount(self, Account):
+        # Authentication is handled by the client when the session has expired
+        Account.client.start_cycle()
+        try:
+            return Account.client.telemeter() if Account.client.get_user_data() else None
+        except Telenet.TelenetCancelled:
+            return None
+        except Exception as err:
+            Domoticz.Error('Polling of {} failed: {}'.format(Account.client.username, err))
+            self.logTraceback()
+            return None
+
+    def updateAccountDevices(self, Account, Contracts):
+        # Only the contracts with a new usage and the failed ones need device work
+        for Contract in Contracts:
+            Unit = self.findContractUnit(Account, Contract)
+            if not Unit:
+                description = CreateDescription({'businessidentifier': Contract.businessidentifier})
+                Unit = CreateDevice(Devices, Unit=Account.next_free_unit(), Name=self.contractName(Account, Contract), Description=description, TypeName="Custom", Options={"Custom": "0;GB"}, Image=Images[_IMAGE].ID, Used=1)
+            UpdateDevice(False, Devices, Unit, 0, '%.3f' % Contract.total_usage_gb)
+            Series = self.Store.append(Contract.businessidentifier, self.clock(), float(Contract.total_usage_gb), self.cycleStart(Contract.businessidentifier))
+            Domoticz.Debug('Telenet Usage {}: {} (today {:.3f}, cycle {:.3f}/day)'.format(Contract.businessidentifier, Contract.total_usage_gb, Series.daily_delta(datetime.date.fromtimestamp(self.clock())), Series.cycle_rate()))
+            self.backfillDailyUsage(Account, Contract)
+            # Only now: when the device work fails, the usage is reported again with the next poll
+            Contract.mark_reported()
+        for Contract in Account.client.telemeter_info:
+            if Contract.usage_ok:
+                Account.received_contracts.add(Contract.businessidentifier)
+                Account.contract_failures.pop(Contract.businessidentifier, None)
+                continue
+            # Same rule as pollFailed: time out once a contract fails repeatedly, or at once while it still shows the previous run
+            Failures = Account.contract_failures[Contract.businessidentifier] = Account.contract_failures.get(Contract.businessidentifier, 0) + 1
+            Domoticz.Debug('Telenet Usage {}: no data received (failure {})'.format(Contract.businessidentifier, Failures))
+            if Failures == _ERROR_THRESHOLD or (Failures == 1 and Contract.businessidentifier not in Account.received_contracts):
+                Unit = self.findContractUnit(Account, Contract)
+                if Unit:
+                    TimeoutDevice(Devices, All=False, Unit=Unit)
+        # Contracts reported again after a timeout or failure do not count as a change for the scheduler
+        return any(Contract.usage_changed for Contract in Contracts)
+
+    def findContractUnit(self, Account, Contract):
+        Unit = FindUnitFromTag(Devices, 'businessidentifier', Contract.businessidentifier)
+        if not Unit:
+            # Devices of older versions were only named after the municipality: tag them once
+            Unit = FindUnitFromName(Devices, Parameters, Account.device_name(Contract.municipality))
+            if not Unit or GetTagFromDescription(Devices, Unit, 'businessidentifier') is not None:
+                return False
+            AddTagToDescription(Devices, Unit, 'businessidentifier', Contract.businessidentifier)
+        return Unit
+
+    def contractName(self, Account, Contract, Suffix=''):
+        # Contracts in the same municipality are told apart by their identifier
+        Name = Contract.municipality
+        if sum(1 for Other in Account.client.telemeter_info if Other.municipality == Contract.municipality) > 1:
+            Name = '{} ({})'.format(Name, Contract.businessidentifier)
+        return Account.device_name(Name + Suffix)
+
+    def accountFailed(self, Account):
+        # Same rule as pollFailed for one account of several; a single account is left to pollFailed
+        Account.failures += 1
+        if len(self.Accounts) > 1 and (Account.failures == _ERROR_THRESHOLD or (Account.failures == 1 and not Account.received)):
+            self.timeoutAccountDevices(Account)
+
+    def timeoutAccountDevices(self, Account):
+        for Contract in Account.client.telemeter_info or []:
+            for tagName in ('businessidentifier', 'daily'):
+                Unit = FindUnitFromTag(Devices, tagName, Contract.businessidentifier)
+                if Unit:
+                    TimeoutDevice(Devices, All=False, Unit=Unit)
+        # Report the usage of these contracts again once they are received
+        Account.client.invalidate_usage()
+
+    def writeMetrics(self, task):
+        # JSON snapshot in the home folder (written atomically) and optional Domoticz devices
+        Accounts = { Account.client.username: Account.client.metrics.snapshot() for Account in self.Accounts }
+        Metrics = { 'accounts': Accounts,
+                    'current_cycle': { 'requests': sum(Account['current_cycle'].get('requests', 0) for Account in Accounts.values()),
+                                       'seconds': max([ Account['current_cycle'].get('seconds', 0) for Account in Accounts.values() ] or [0]) } }
+        Metrics['queue'] = self.tasksQueue.stats()
+        Metrics['task'] = task['Action']
+        Metrics['time'] = time.time()
+        FileName = '{}{}'.format(Parameters['HomeFolder'], _METRICS_FILE)
+        with open(FileName + '.tmp', 'w') as outfile:
+            json.dump(Metrics, outfile, indent=1)
+        os.replace(FileName + '.tmp', FileName)
+        if Parameters['Mode4'] == 'True' and task['Action'] == 'GetInternetVolume':
+            for Name, (Label, Value) in _METRICS_DEVICES.items():
+                Unit = FindUnitFromName(Devices, Parameters, Name)
+                if not Unit:
+                    Unit = CreateDevice(Devices, Name=Name, TypeName="Custom", Options={"Custom": "0;{}".format(Label)}, Image=Images[_IMAGE].ID, Used=0)
+                UpdateDevice(False, Devices, Unit, 0, '%.3f' % Value(Metrics))
+
+    def backfillDailyUsage(self, Account, Contract):
+        # Feed the days newer than the last stored one in a managed counter (MB per day)
+        if not Contract.daily_usage_gb:
+            # Without a daily series the counter would only repeat the total: no device
+            Domoticz.Debug('Telenet daily usage {}: no daily series (internet.dailyUsages) recognised in the usage response'.format(Contract.businessidentifier))
+            return
+        Unit = FindUnitFromTag(Devices, 'daily', Contract.businessidentifier)
+        if not Unit:
+            Unit = CreateDevice(Devices, Unit=Account.next_free_unit(), Name=self.contractName(Account, Contract, ' daily'), Type=243, Subtype=33, Switchtype=3,
+                                Description=CreateDescription({'daily': Contract.businessidentifier}),
+                                Options={'ValueQuantity': 'Volume', 'ValueUnits': 'MB'}, Image=Images[_IMAGE].ID, Used=1)
+        LastDay = GetTagFromDescription(Devices, Unit, 'lastday') or ''
+        Today = datetime.date.fromtimestamp(self.clock()).isoformat()
+        Days = [ Day for Day in Contract.daily_usage_gb if LastDay < Day[0] < Today ]
+        Cycle = self.BillingCycles.get(Contract.businessidentifier, {})
+        if LastDay < Cycle.get('startDate', '')[:10]:
+            # Catch up on previous billing cycles (one request per missing cycle)
+            Days = Account.client.get_past_daily_usage(Contract, LastDay) + Days
+        # History rows are written directly: the device update batch would merge them
+        for Day, Usage in Days:
+            Devices[Unit].Update(nValue=0, sValue='-1;{};{}'.format(int(round(Usage*1000)), Day))
+        if Days:
+            AddTagsToDescription(Devices, Unit, {'lastday': Days[-1][0]})
+            Domoticz.Debug('Telenet daily usage {}: backfilled {} days up to {}'.format(Contract.businessidentifier, len(Days), Days[-1][0]))
+        TodayUsage = dict(Contract.daily_usage_gb).get(Today, 0)
+        UpdateDevice(False, Devices, Unit, 0, '{};{}'.format(int(round(float(Contract.total_usage_gb)*1000)), int(round(TodayUsage*1000))))
+
+    def cycleStart(self, Identifier):
+        Cycle = self.BillingCycles.get(Identifier)
+        try:
+            return time.mktime(datetime.date.fromisoformat(Cycle['startDate'][:10]).timetuple())
+        except (TypeError, ValueError):
+            return None
+
+    def pollFailed(self):
+        self.Scheduler.failure()
+        Domoticz.Debug('Unable to get data from Telenet (failure {}), retry in {:.0f}s.'.format(self.Scheduler.failures, self.Scheduler.next_due-self.clock()))
+        if self.Scheduler.failures == 1 and not self.Received:
+            # Nothing received since the start: the devices still show the values of the previous run
+            self.timeoutAllDevices()
+        if self.Scheduler.failures >= _ERROR_THRESHOLD:
+            Domoticz.Error('Unable to get data from Telenet ({} consecutive failures).'.format(self.Scheduler.failures))
+            if self.Scheduler.failures == _ERROR_THRESHOLD:
+                self.timeoutAllDevices()
+
+    def timeoutAllDevices(self):
+        TimeoutDevice(Devices, All=True)
+        for Account in self.Accounts:
+            Account.client.invalidate_usage()
 
 
 global _plugin
@@ -226,3 +738,10 @@ def onHeartbeat():
 ################################################################################
 # Specific helper functions
 ################################################################################
+
+def loadTelenet():
+    # Import Telenet (requests, urllib3, certifi, ...) on first use instead of on the Domoticz thread
+    global Telenet
+    if Telenet is None:
+        import Telenet
+    return Telenet
@@ -0,0 +1,121 @@
+"""
+Compact, append-only store of telemeter readings.
+
+Every contract has its own file with fixed-width records of two doubles
+(timestamp, total usage in GB) that can be memory-mapped for reads.
+Daily deltas and the cycle-to-date rate are kept up to date in O(1) per
+appended reading.
+"""
+
+import array
+import datetime
+import mmap
+import os
+import re
+import threading
+
+RECORD = 'd'               # array type code of the record fields
+FIELDS = 2                 # timestamp, usage
+RECORD_SIZE = array.array(RECORD).itemsize * FIELDS
+DAYS_KEPT = 400            # daily deltas kept in memory
+
+
+class TelemeterSeries():
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.count = 0
+        self.last_time = None
+        self.last_usage = None
+        self.day = None
+        self.day_delta = 0.0
+        self.daily = {}
+        self.cycle_start = None
+        # Drop a partially written record (e.g. after a crash) and build the aggregates once
+        if os.path.exists(filename):
+            size = os.path.getsize(filename)
+            if size % RECORD_SIZE:
+                with open(filename, 'r+b') as outfile:
+                    outfile.truncate(size - size % RECORD_SIZE)
+            for timestamp, usage in self.readings():
+                self._aggregate(timestamp, usage)
+
+    def append(self, timestamp, usage, cycle_start=None):
+        record = array.array(RECORD, [timestamp, usage])
+        with self.lock:
+            with open(self.filename, 'ab') as outfile:
+                outfile.write(record.tobytes())
+            if cycle_start is not None:
+                self.cycle_start = cycle_start
+            self._aggregate(timestamp, usage)
+
+    def _aggregate(self, timestamp, usage):
+        # The usage counter only grows within a billing cycle and restarts at zero with a new cycle
+        if self.last_usage is None:
+            increment = 0.0
+        elif usage >= self.last_usage:
+            increment = usage - self.last_usage
+        else:
+            increment = usage
+            self.cycle_start = timestamp
+        day = datetime.date.fromtimestamp(timestamp)
+        if day != self.day:
+            if self.day is not None:
+                self.daily[self.day] = self.day_delta
+                if len(self.daily) > DAYS_KEPT:
+                    del self.daily[min(self.daily)]
+            self.day, self.day_delta = day, 0.0
+        self.day_delta += increment
+        if self.cycle_start is None:
+            self.cycle_start = timestamp
+        self.count += 1
+        self.last_time, self.last_usage = timestamp, usage
+
+    def readings(self):
+        # Memory-mapped (timestamp, usage) pairs
+        if not os.path.exists(self.filename) or os.path.getsize(self.filename) < RECORD_SIZE:
+            return
+        with open(self.filename, 'rb') as infile:
+            with mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                values = memoryview(mapped)[:len(mapped) - len(mapped) % RECORD_SIZE].cast(RECORD)
+                try:
+                    for index in range(0, len(values), FIELDS):
+                        yield values[index], values[index+1]
+                finally:
+                    values.release()
+
+    def daily_delta(self, day=None):
+        # Usage (GB) during the given day (default: today so far, 0.0 when no reading arrived today)
+        day = day or datetime.date.today()
+        with self.lock:
+            if day == self.day:
+                return self.day_delta
+            return self.daily.get(day, 0.0)
+
+    def cycle_rate(self, now=None):
+        # Average usage (GB per day) since the start of the billing cycle
+        with self.lock:
+            if self.last_usage is None or self.cycle_start is None:
+                return 0.0
+            days = ((now or self.last_time) - self.cycle_start) / 86400
+            return self.last_usage / days if days > 0 else 0.0
+
+
+class TelemeterStore():
+
+    def __init__(self, folder, prefix='Telenet_'):
+        self.folder = folder
+        self.prefix = prefix
+        self.series = {}
+
+    def get(self, identifier):
+        if identifier not in self.series:
+            filename = os.path.join(self.folder, '{}{}.tms'.format(self.prefix, re.sub(r'[^\w.-]', '_', identifier)))
+            self.series[identifier] = TelemeterSeries(filename)
+        return self.series[identifier]
+
+    def append(self, identifier, timestamp, usage, cycle_start=None):
+        series = self.get(identifier)
+        series.append(timestamp, usage, cycle_start)
+        return series